@@ -2,18 +2,28 @@ import os
 try:
     import busio
     import armachat_lora
-    import aesio
 except ImportError:
     pass
+try:
+    import aesio
+except ImportError:
+    # Desktop runs use the pure Python stand-in
+    import softaes as aesio
 
 from collections import namedtuple
+from array import array
 import time
+import random
 import struct
 import binascii
 
 import minipb
 
-MeshtasticData = minipb.Wire([
+# Packets come off the air from anyone, so bound what decoding them can
+# cost: nothing after the 16 byte header of a 255 byte frame is longer
+MESHTASTIC_LIMITS = dict(max_fields=32, max_vint_bytes=10, max_bytes=255 - 16)
+
+MESHTASTIC_DATA_FORMAT = [
     ("portnum", "t"),
     ("payload", "a"),
     ("want_response", "b"),
@@ -22,9 +32,9 @@ MeshtasticData = minipb.Wire([
     ("request_id", "I"),
     ("reply_id", "I"),
     ("emoji", "I"),
-])
+]
 
-MeshtasticNodeInfo = minipb.Wire([
+MESHTASTIC_NODEINFO_FORMAT = [
     ("num", "T"),
     ("user", [
         ("id", "U"),
@@ -38,20 +48,541 @@ MeshtasticNodeInfo = minipb.Wire([
     ("snr", "f"),
     ("last_heard", "I"),
     ("device_metrics", "x"),
-])
+]
+
+# Routing payload of portnum 5, an error_reason of 0 acknowledges request_id
+MESHTASTIC_ROUTING_FORMAT = [
+    ("route_request", "x"),
+    ("route_reply", "x"),
+    ("error_reason", "t"),
+]
+
+MeshtasticData = minipb.Wire(MESHTASTIC_DATA_FORMAT).set_limits(**MESHTASTIC_LIMITS).compile("MeshtasticData")
+MeshtasticNodeInfo = minipb.Wire(MESHTASTIC_NODEINFO_FORMAT).set_limits(**MESHTASTIC_LIMITS).compile("MeshtasticNodeInfo")
+MeshtasticRouting = minipb.Wire(MESHTASTIC_ROUTING_FORMAT).set_limits(**MESHTASTIC_LIMITS).compile("MeshtasticRouting")
+# Only ever encodes our own announcement, so it can skip the checks
+OwnNodeInfo = minipb.Wire(MESHTASTIC_NODEINFO_FORMAT, trusted=True)
+
+# The parts of a NodeInfo announcement loop() looks at
+NODEINFO_FIELDS = ("user.id", "user.short_name", "user.macaddr")
+
+# What Communication uses of the radio, a radio= object needs all of it
+RADIO_SURFACE = ("listen", "send", "rx_done", "receive", "last_snr", "last_rssi")
+
+# Frame header as Meshtastic lays it out: destination, sender and packet
+# id as little endian numbers, then flags and channel hash. The next hop
+# and relay node bytes that follow are not used.
+HEADER_FORMAT = "<IIIBB"
+HEADER_SIZE = 16
+BROADCAST_NUM = 0xffffffff
+# Flag bits, hop_start repeats the hop limit the packet was sent with
+FLAG_HOP_LIMIT = 0b00000111
+FLAG_WANT_ACK = 0b00001000
+FLAG_HOP_START = 0b11100000
+
+
+class PacketHistory:
+    """
+    Recently seen (sender, packet id) pairs, so the copies of a packet
+    that reach us through relays can be dropped before they are decoded.
+    Entries live in preallocated arrays used as an open addressed hash
+    table. A lookup probes a fixed window of slots, entries older than
+    ttl milliseconds count as free and a full window gives up its oldest
+    entry, so neither memory nor time per packet grows with traffic.
+    """
+    # Slots probed per lookup
+    window = 8
+
+    def __init__(self, size=64, ttl=10 * 60 * 1000):
+        # size must be a power of two
+        self.mask = size - 1
+        self.ttl = ttl
+        self.senders = array("I", [0] * size)
+        self.ids = array("I", [0] * size)
+        # Arrival time in ms, truncated to 32 bits
+        self.times = array("I", [0] * size)
+        self.used = bytearray(size)
+        self.duplicates = 0
+
+    def seen(self, sender, packet_id, now):
+        """
+        Record the packet and return True if it was already recorded less
+        than ttl ms ago. sender and packet_id are 32 bit ints, now is in ms.
+        """
+        now &= 0xffffffff
+        mask = self.mask
+        senders = self.senders
+        ids = self.ids
+        times = self.times
+        used = self.used
+        ttl = self.ttl
+        slot = ((sender * 0x9e3779b1) ^ packet_id) & mask
+        free = -1
+        oldest = slot
+        oldest_age = -1
+        for _ in range(self.window):
+            if used[slot]:
+                age = (now - times[slot]) & 0xffffffff
+                if age >= ttl:
+                    used[slot] = 0
+                elif senders[slot] == sender and ids[slot] == packet_id:
+                    self.duplicates += 1
+                    return True
+                elif age > oldest_age:
+                    oldest = slot
+                    oldest_age = age
+            if not used[slot] and free < 0:
+                free = slot
+            slot = (slot + 1) & mask
+        if free < 0:
+            free = oldest
+        senders[free] = sender
+        ids[free] = packet_id
+        times[free] = now
+        used[free] = 1
+        return False
+
+
+def lora_airtime(length, sf=7, bw=125000, cr=5, preamble=8, ldro=False):
+    """
+    Time on air in ms of a length byte frame with explicit header and CRC,
+    from the Semtech SX127x datasheet. cr is the coding rate denominator
+    (5 to 8) as in the RFM9x driver.
+    """
+    symbol = (1 << sf) * 1000 / bw
+    bits = 8 * length - 4 * sf + 28 + 16
+    per_block = 4 * (sf - 2 if ldro else sf)
+    blocks = -(-bits // per_block) if bits > 0 else 0
+    return (preamble + 4.25 + 8 + blocks * cr) * symbol
+
+
+# Transmit priorities, lower goes first
+PRIORITY_ACK = 0
+PRIORITY_TEXT = 1
+PRIORITY_RELAY = 2
+PRIORITY_ANNOUNCE = 3
+
+
+class AirtimeBudget:
+    """
+    Airtime spent over a rolling window, kept in a ring of per bucket ms
+    totals. duty_cycle is the regional cap in percent of the window.
+    """
+
+    def __init__(self, duty_cycle=100, window=60 * 60 * 1000, buckets=60):
+        self.limit = window * duty_cycle // 100
+        self.span = window // buckets
+        self.spent = array("I", [0] * buckets)
+        self.tick = None
+
+    def advance(self, now):
+        tick = now // self.span
+        if self.tick is None:
+            self.tick = tick
+        spent = self.spent
+        steps = min(tick - self.tick, len(spent))
+        for step in range(1, steps + 1):
+            spent[(self.tick + step) % len(spent)] = 0
+        self.tick = max(tick, self.tick)
+
+    def used(self, now):
+        """Airtime in ms spent within the window."""
+        self.advance(now)
+        return sum(self.spent)
+
+    def allows(self, airtime, now):
+        return self.used(now) + airtime <= self.limit
+
+    def charge(self, airtime, now):
+        self.advance(now)
+        self.spent[self.tick % len(self.spent)] += int(airtime + 0.5)
+
+
+class TxScheduler:
+    """
+    Frames waiting for the radio. Every slot owns a frame sized buffer
+    allocated up front and records the frame's priority, the time it may
+    be sent and the (sender, packet id) it carries. The highest priority
+    frame that is due goes first, provided the airtime budget has room for
+    it; frames of equal priority leave in the order they were queued.
+    A full queue makes room by dropping its least important frame.
+    """
+
+    def __init__(self, size=10, max_frame=255, budget=None, airtime=lora_airtime):
+        self.frames = [bytearray(max_frame) for _ in range(size)]
+        # Frame length per slot, 0 marks a free slot
+        self.lengths = bytearray(size)
+        self.priorities = bytearray(size)
+        self.senders = array("I", [0] * size)
+        self.ids = array("I", [0] * size)
+        # Time in ms, truncated to 32 bits, when the frame may be sent
+        self.due = array("I", [0] * size)
+        self.order = array("I", [0] * size)
+        self.queued = 0
+        self.budget = budget or AirtimeBudget()
+        self.airtime = airtime
+        self.sent = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.deferred = 0
+
+    def add(self, priority, packet, due, hops=None):
+        """
+        Queue a copy of packet, optionally with its hop limit set to hops.
+        Returns False and counts the packet as dropped if the queue is full
+        of frames at least as important.
+        """
+        lengths = self.lengths
+        priorities = self.priorities
+        slot = -1
+        for index in range(len(lengths)):
+            if not lengths[index]:
+                slot = index
+                break
+            if priorities[index] > priority and (slot < 0 or priorities[index] >= priorities[slot]):
+                slot = index
+        if slot < 0:
+            self.dropped += 1
+            return False
+        if lengths[slot]:
+            self.dropped += 1
+        frame = self.frames[slot]
+        length = len(packet)
+        frame[0:length] = packet
+        if hops is not None:
+            frame[12] = (frame[12] & ~FLAG_HOP_LIMIT) | hops
+        sender, packet_id = struct.unpack_from("<II", frame, 4)
+        lengths[slot] = length
+        priorities[slot] = priority
+        self.senders[slot] = sender
+        self.ids[slot] = packet_id
+        self.due[slot] = due & 0xffffffff
+        self.order[slot] = self.queued & 0xffffffff
+        self.queued += 1
+        return True
+
+    def cancel(self, sender, packet_id, priority=PRIORITY_RELAY):
+        """Forget a queued frame of the given priority, True if there was one."""
+        lengths = self.lengths
+        for slot in range(len(lengths)):
+            if (lengths[slot] and self.priorities[slot] == priority
+                    and self.senders[slot] == sender and self.ids[slot] == packet_id):
+                lengths[slot] = 0
+                self.cancelled += 1
+                return True
+        return False
+
+    def pending(self):
+        return len(self.lengths) - self.lengths.count(0)
+
+    def next(self, now):
+        """
+        Return the frame to send now and charge its airtime, or None. The
+        returned view stays valid until the next call to add().
+        """
+        now32 = now & 0xffffffff
+        lengths = self.lengths
+        priorities = self.priorities
+        order = self.order
+        best = -1
+        for slot in range(len(lengths)):
+            # Unsigned 32 bit difference, due is in the past below 2**31
+            if lengths[slot] and (now32 - self.due[slot]) & 0xffffffff < 0x80000000:
+                if (best < 0 or priorities[slot] < priorities[best]
+                        or (priorities[slot] == priorities[best]
+                            and (order[slot] - order[best]) & 0xffffffff >= 0x80000000)):
+                    best = slot
+        if best < 0:
+            return None
+        length = lengths[best]
+        airtime = self.airtime(length)
+        if not self.budget.allows(airtime, now):
+            self.deferred += 1
+            return None
+        self.budget.charge(airtime, now)
+        lengths[best] = 0
+        self.sent += 1
+        return memoryview(self.frames[best])[0:length]
+
+
+class AckTracker:
+    """
+    Packets sent with want_ack that still wait for their routing ack, keyed
+    by packet id. Every slot keeps a copy of the frame for retransmission
+    in a buffer allocated up front. A packet that times out is sent again
+    with the timeout doubled, up to max_timeout, until retries run out.
+    """
+
+    def __init__(self, size=8, max_frame=255, retries=3, max_timeout=60 * 1000):
+        self.frames = [bytearray(max_frame) for _ in range(size)]
+        # Frame length per slot, 0 marks a free slot
+        self.lengths = bytearray(size)
+        self.ids = array("I", [0] * size)
+        # Timeout of the first attempt and time in ms, truncated to 32 bits,
+        # when the current attempt expires
+        self.timeouts = array("I", [0] * size)
+        self.deadlines = array("I", [0] * size)
+        self.attempts = bytearray(size)
+        self.retries = retries
+        self.max_timeout = max_timeout
+        self.delivered = 0
+        self.failed = 0
+        self.retransmits = 0
+        self.untracked = 0
+
+    def add(self, packet_id, frame, timeout, now):
+        """Start waiting for an ack, False if every slot is taken."""
+        lengths = self.lengths
+        for slot in range(len(lengths)):
+            if not lengths[slot]:
+                length = len(frame)
+                self.frames[slot][0:length] = frame
+                lengths[slot] = length
+                self.ids[slot] = packet_id
+                self.timeouts[slot] = timeout
+                self.deadlines[slot] = (now + timeout) & 0xffffffff
+                self.attempts[slot] = 0
+                return True
+        self.untracked += 1
+        return False
+
+    def ack(self, packet_id):
+        """Stop waiting for packet_id, True if it was pending."""
+        lengths = self.lengths
+        for slot in range(len(lengths)):
+            if lengths[slot] and self.ids[slot] == packet_id:
+                lengths[slot] = 0
+                return True
+        return False
+
+    def expired(self, now):
+        """Slot whose current attempt has timed out, or -1."""
+        now &= 0xffffffff
+        lengths = self.lengths
+        for slot in range(len(lengths)):
+            # Unsigned 32 bit difference, the deadline passed below 2**31
+            if lengths[slot] and (now - self.deadlines[slot]) & 0xffffffff < 0x80000000:
+                return slot
+        return -1
+
+    def retry(self, slot, now):
+        """
+        Arm the next attempt of an expired slot and return its frame, or
+        None after the last retry, in which case the slot is freed.
+        """
+        if self.attempts[slot] >= self.retries:
+            self.lengths[slot] = 0
+            self.failed += 1
+            return None
+        self.attempts[slot] += 1
+        self.retransmits += 1
+        timeout = min(self.timeouts[slot] << self.attempts[slot], self.max_timeout)
+        self.deadlines[slot] = (now + timeout) & 0xffffffff
+        return memoryview(self.frames[slot])[0:self.lengths[slot]]
+
+
+# What a MessageSlot holds
+KIND_TEXT = 0
+KIND_STATUS = 1
+KIND_DELIVERY = 2
+
+# What MessageRing does when a slot is needed and all of them are taken
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+
+
+class MessageSlot:
+    """
+    One entry of a MessageRing. Text is copied into the payload buffer
+    allocated with the slot, src holds the sender's 4 byte address.
+    """
+
+    def __init__(self, max_payload):
+        self.kind = KIND_TEXT
+        self.src = bytearray(4)
+        self.id = 0
+        self.flags = 0
+        self.s = 0
+        self.rssi = 0
+        self.tstamp = None
+        self.delivered = False
+        self.payload = bytearray(max_payload)
+        self.length = 0
+
+    def set_payload(self, data):
+        length = min(len(data), len(self.payload))
+        if length < len(data):
+            # Do not leave half of a UTF-8 sequence at the end
+            while length and data[length] & 0b11000000 == 0b10000000:
+                length -= 1
+        self.payload[0:length] = data[0:length]
+        self.length = length
+
+    def text(self):
+        try:
+            return str(self.payload[0:self.length], "utf-8")
+        except UnicodeError:
+            # Whatever arrived off the air, show it rather than fail
+            return str(binascii.hexlify(self.payload[0:self.length]), "utf-8")
+
+
+class MessageRing:
+    """
+    Fixed number of preallocated MessageSlots passing received text,
+    status lines and delivery reports from Communication to Terminal.
+    When every slot is taken, policy decides whether the oldest unread
+    slot is overwritten (DROP_OLDEST) or the new entry is discarded
+    (DROP_NEWEST); either way dropped is counted.
+    """
+
+    def __init__(self, size=16, max_payload=255 - 16, policy=DROP_OLDEST):
+        self.slots = [MessageSlot(max_payload) for _ in range(size)]
+        self.policy = policy
+        self.head = 0
+        self.count = 0
+        self.pushed = 0
+        self.popped = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, kind):
+        """
+        Claim the next slot and set its kind, or return None if the policy
+        drops the new entry. The caller fills in the rest of the slot.
+        """
+        size = len(self.slots)
+        if self.count == size:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return None
+            self.head = (self.head + 1) % size
+            self.count -= 1
+        slot = self.slots[(self.head + self.count) % size]
+        self.count += 1
+        self.pushed += 1
+        self.high_water = max(self.high_water, self.count)
+        slot.kind = kind
+        return slot
+
+    def pop(self):
+        """
+        Oldest unread slot or None. The slot stays valid until reserve()
+        has gone round the ring and claims it again.
+        """
+        if not self.count:
+            return None
+        slot = self.slots[self.head]
+        self.head = (self.head + 1) % len(self.slots)
+        self.count -= 1
+        self.popped += 1
+        return slot
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+
+# Meshtastic's default channel key, which a one byte PSK of 1 ("AQ==") means
+DEFAULT_PSK = b"\xd4\xf1\xbb\x3a\x20\x29\x07\x59\xf0\xbc\xff\xab\xcf\x4e\x69\x01"
+
+
+class ChannelCipher:
+    """
+    Meshtastic channel encryption: AES-CTR over everything after the
+    header, with a nonce made of the packet id and the sender's address.
+    The AES context is made once and rekeyed with each packet's nonce,
+    frames are encrypted and decrypted in place. An empty PSK, or a one
+    byte PSK of 0, leaves frames in the clear.
+    """
+
+    def __init__(self, psk, name="LongFast"):
+        self.key = self.expand_psk(psk or b"")
+        self.hash = self.xor_hash(name.encode("utf-8")) ^ self.xor_hash(self.key or b"")
+        self.nonce = bytearray(16)
+        self.aes = aesio.AES(self.key, aesio.MODE_CTR, self.nonce) if self.key else None
+
+    @staticmethod
+    def expand_psk(psk):
+        """
+        The AES key a channel PSK stands for, None for no encryption.
+        Raises ValueError for a PSK longer than an AES-256 key.
+        """
+        if len(psk) > 32:
+            raise ValueError("Channel PSK is {0} bytes, at most 32 are allowed".format(len(psk)))
+        if not psk or psk == b"\x00":
+            return None
+        if len(psk) == 1:
+            # Shorthand for the default key with its last byte bumped
+            key = bytearray(DEFAULT_PSK)
+            key[-1] = (key[-1] + psk[0] - 1) & 0xff
+            return bytes(key)
+        if len(psk) < 16:
+            return bytes(psk) + bytes(16 - len(psk))
+        if 16 < len(psk) < 32:
+            return bytes(psk) + bytes(32 - len(psk))
+        return bytes(psk)
+
+    @staticmethod
+    def xor_hash(data):
+        result = 0
+        for byte in data:
+            result ^= byte
+        return result
+
+    def crypt(self, frame, length):
+        """Encrypt or decrypt frame[16:length] in place, CTR is symmetric."""
+        if self.aes is None:
+            return
+        nonce = self.nonce
+        # Packet id and sender as 64 bit little endian numbers
+        nonce[0:4] = frame[8:12]
+        nonce[8:12] = frame[4:8]
+        self.aes.rekey(self.key, nonce)
+        body = memoryview(frame)[16:length]
+        self.aes.encrypt_into(body, body)
 
 
 class Communication:
     broadcast = b"\xff\xff\xff\xff"
+    # Largest frame the SX127x FIFO can send
+    max_frame = 255
+    # Length of a routing ack frame
+    ack_frame = 16 + 11
+    # Contention window exponents and the SNR range mapped onto them when
+    # delaying a relay, following Meshtastic's weighted TX delay
+    cw_min = 3
+    cw_max = 8
+    snr_min = -20
+    snr_max = 10
 
-    def __init__(self, lora_config=None, my_address=None, remote_address=None, encryption_key=None, encryption_iv=None, nick=None, beep=None, led=None):
-        self.lora_config = lora_config
+    def __init__(self, lora_config=None, my_address=None, remote_address=None, encryption_key=None, encryption_iv=None, nick=None, beep=None, led=None, relay=False, channel="LongFast", radio=None):
+        # slot_time() and frame_airtime() read it, also with radio= only
+        self.lora_config = lora_config or {}
         self.lora = None
+        # Anything with RADIO_SURFACE, used instead of the SX127x
+        if radio is not None:
+            missing = [name for name in RADIO_SURFACE if not hasattr(radio, name)]
+            if missing:
+                raise TypeError("radio has no {0}".format(", ".join(missing)))
+        self.radio = radio
         self.my_address = my_address
-        self.messages = []
-        self.encryption_key = encryption_key
-        self.encryption_key = None
-        self.encryption_iv = encryption_iv
+        # Addresses as header numbers, so filtering compares integers
+        self.my_num = struct.unpack("<I", my_address)[0]
+        self.messages = MessageRing(max_payload=self.max_frame - 16)
+        self.tx_frame = bytearray(self.max_frame)
+        self.history = PacketHistory()
+        self.relay = relay
+        self.acks = AckTracker(max_frame=self.max_frame)
+        self.tx_queue = TxScheduler(
+            max_frame=self.max_frame,
+            budget=AirtimeBudget(duty_cycle=self.lora_config.get("dc", 100)),
+            airtime=self.frame_airtime)
+        # encryption_key is the channel PSK, encryption_iv is not used as
+        # the nonce comes from the frame header
+        self.channel = ChannelCipher(encryption_key, channel)
         self.idx = 0
         self.nick = nick
         self.beep = beep
@@ -59,8 +590,15 @@ class Communication:
 
     Message = namedtuple(
         "Message", ["dst", "src", "id", "flags", "s", "rssi", "tstamp", "packet"])
+    Header = namedtuple("Header", ["dest", "src", "id", "flags", "channel"])
 
     def initialize(self):
+        if self.radio is not None:
+            self.lora = self.radio
+            self.lora.listen()
+            self.announce_myself()
+            return
+
         if "m" not in self.lora_config:
             self.lora_config = {"m": "e5"}
             return
@@ -84,29 +622,160 @@ class Communication:
         return self.messages
 
     def clear_messages(self):
-        self.messages = []
+        self.messages.clear()
+
+    def post_text(self, message, text):
+        slot = self.messages.reserve(KIND_TEXT)
+        if slot is not None:
+            struct.pack_into("<I", slot.src, 0, message.src)
+            slot.id = message.id
+            slot.flags = message.flags
+            slot.s = message.s
+            slot.rssi = message.rssi
+            slot.tstamp = message.tstamp
+            slot.set_payload(text)
+
+    def post_status(self, line):
+        slot = self.messages.reserve(KIND_STATUS)
+        if slot is not None:
+            slot.tstamp = time.localtime()
+            slot.set_payload(line.encode("utf-8"))
+
+    def post_delivery(self, packet_id, delivered):
+        slot = self.messages.reserve(KIND_DELIVERY)
+        if slot is not None:
+            slot.id = packet_id
+            slot.delivered = delivered
 
     def format_address(self, address):
         return str(binascii.hexlify(address), "utf-8")
 
+    def slot_time(self):
+        """Contention window slot length in ms for the configured modem."""
+        sf = self.lora_config.get("sf", 7)
+        bw = self.lora_config.get("bw", 125000)
+        # 2.5 symbols covers channel activity detection plus turnaround
+        return 2.5 * (1 << sf) * 1000 / bw + 1
+
+    def relay_delay(self, snr):
+        """
+        Random relay delay in ms. The window grows with SNR so distant nodes,
+        which add the most coverage, relay first and nearby ones usually
+        hear them and cancel.
+        """
+        snr = min(max(snr, self.snr_min), self.snr_max)
+        cw = self.cw_min + int((snr - self.snr_min) * (self.cw_max - self.cw_min)
+                               / (self.snr_max - self.snr_min) + 0.5)
+        return int(random.randint(0, (1 << cw) - 1) * self.slot_time())
+
+    def frame_airtime(self, length):
+        """Time on air in ms of a length byte frame with the configured modem."""
+        config = self.lora_config
+        return lora_airtime(length, sf=config.get("sf", 7), bw=config.get("bw", 125000),
+                            cr=config.get("cr", 5), preamble=config.get("pl", 8),
+                            ldro=bool(config.get("ld", 0)))
+
+    def transmit(self, now):
+        """Send at most one queued frame, so the UI loop never waits long."""
+        frame = self.tx_queue.next(now)
+        if frame is None:
+            return False
+        self.led.value = True
+        self.lora.send(frame)
+        self.led.value = False
+        return True
+
+    def ack_timeout(self, length, hops):
+        """
+        ms to wait for the ack of a length byte frame: the frame and the
+        ack both cross up to hops relays, each waiting out a full contention
+        window before passing them on.
+        """
+        window = (1 << self.cw_max) * self.slot_time()
+        per_hop = self.frame_airtime(length) + self.frame_airtime(self.ack_frame) + window
+        return int(per_hop * (hops + 1))
+
+    def check_acks(self, now):
+        """Retransmit packets whose ack is overdue and report the ones that failed."""
+        acks = self.acks
+        slot = acks.expired(now)
+        while slot >= 0:
+            packet_id = acks.ids[slot]
+            frame = acks.retry(slot, now)
+            if frame is None:
+                self.post_delivery(packet_id, False)
+            else:
+                # If the queue is full this attempt is lost, the next
+                # timeout retries again
+                self.tx_queue.add(PRIORITY_TEXT, frame, now)
+            slot = acks.expired(now)
+
+    def delivered(self, packet_id, ok=True):
+        if self.acks.ack(packet_id):
+            if ok:
+                self.acks.delivered += 1
+            else:
+                self.acks.failed += 1
+            self.post_delivery(packet_id, ok)
+            return True
+        return False
+
+    def send_ack(self, destination, packet_id, error_reason=0):
+        """Answer a packet sent to us with want_ack with a routing ack."""
+        packet = MeshtasticData.record(
+            portnum=5,
+            payload=MeshtasticRouting.encode({"route_request": None, "route_reply": None,
+                                              "error_reason": error_reason}),
+            want_response=None,
+            dest=None,
+            source=None,
+            request_id=packet_id,
+            reply_id=None,
+            emoji=None,
+        )
+        return self.send(self.my_address, destination.to_bytes(4, "little"), packet, id=os.urandom(4),
+                         want_ack=False, priority=PRIORITY_ACK)
+
+    def handle_routing(self, message):
+        request_id = message.packet['request_id']
+        if not request_id:
+            return False
+        try:
+            routing = MeshtasticRouting.decode(message.packet['payload'], copy=False)
+        except Exception as e:
+            print("Failed to decode routing packet", str(e))
+            return False
+        return self.delivered(request_id, ok=not routing.error_reason)
+
     def loop(self):
         if not self.lora:
             return 
+        now = int(time.monotonic() * 1000)
+        self.check_acks(now)
+        self.transmit(now)
         self.led.value = True
         if self.lora.rx_done():
             message = self.receive()
             if message:
                 refresh = False
-                if message.packet['portnum'] == 1: # Text message
-                    self.messages.append(message)
+                if message.packet['portnum'] == 1 and message.packet['payload'] is not None: # Text message
+                    # The text is copied out of the receive buffer into a ring slot
+                    self.post_text(message, message.packet['payload'])
                     self.beep()
                     refresh = True
+                if message.packet['portnum'] == 5: # Routing message
+                    refresh = self.handle_routing(message)
                 if message.packet['portnum'] == 4: # Nodeinfo message
-                    node_info = MeshtasticNodeInfo.decode(message.packet['payload'])
-                    if node_info:
-                        refresh = self.nick[3](node_info['user']['macaddr'], node_info['user']['id'])
+                    try:
+                        node_info = MeshtasticNodeInfo.decode(message.packet['payload'], copy=False, fields=NODEINFO_FIELDS)
+                    except Exception as e:
+                        print("Failed to decode nodeinfo", str(e))
+                        node_info = None
+                    user = node_info.user if node_info else None
+                    if user is not None and user.id is not None and user.macaddr is not None:
+                        refresh = self.nick[3](user.macaddr, user.id)
                         if refresh:
-                            self.messages.append("-!- %s [%s@%s] has joined." % (node_info['user']['id'], node_info['user']['short_name'], binascii.hexlify(node_info['user']['macaddr']).decode("utf-8")))
+                            self.post_status("-!- %s [%s@%s] has joined." % (user.id, user.short_name, binascii.hexlify(user.macaddr).decode("utf-8")))
                             self.announce_myself()
                 self.led.value = False
                 return refresh
@@ -125,13 +794,13 @@ class Communication:
                 "is_licensed": False,
             },
             "position": None,
-            "snr": self.lora.last_snr,
+            "snr": self.lora.last_snr if self.lora else None,
             "last_heard": None,
             "device_metrics": None,
         }
         packet = {
             "portnum": 4,
-            "payload": MeshtasticNodeInfo.encode(nodeinfo_packet),
+            "payload": OwnNodeInfo.encode(nodeinfo_packet),
             "want_response": None,
             "dest": None,
             "source": None,
@@ -140,90 +809,133 @@ class Communication:
             "emoji": None,
         }
         msg_id = os.urandom(4)
-        self.send(self.my_address, self.broadcast, packet, id=msg_id, want_ack=False)
+        self.send(self.my_address, self.broadcast, packet, id=msg_id, want_ack=False,
+                  priority=PRIORITY_ANNOUNCE)
+
+    def text_packet(self, text):
+        return MeshtasticData.record(
+            portnum=1,
+            payload=text.encode("utf-8"),
+            want_response=None,
+            dest=None,
+            source=None,
+            request_id=None,
+            reply_id=None,
+            emoji=None,
+        )
+
+    def text_fits(self, text):
+        """
+        True if text can be sent in a single frame. Sized from the string,
+        terminal.py calls this on every keystroke.
+        """
+        size = minipb._utf8_size(text)
+        # portnum key and value, payload key and length, then the text
+        return HEADER_SIZE + 3 + minipb._vint_size(size) + size <= self.max_frame
 
     def send_message(self, remote_address=b"\xff\xff\xff\xff", text=""):
         msg_id = os.urandom(4)
-        packet = {
-            "portnum": 1,
-            "payload": text.encode("utf-8"),
-            "want_response": None,
-            "dest": None,
-            "source": None,
-            "request_id": None,
-            "reply_id": None,
-            "emoji": None,
-        }
+        packet = self.text_packet(text)
         msg = self.send(self.my_address, remote_address,
                         packet, id=msg_id, want_ack=True)
         if msg:
-            self.messages.append(msg)
+            self.post_text(msg, packet.payload)
             return True
         return False
 
     def receive(self):
-        header = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-
         packet = self.lora.receive()
         if packet is None:
             print("Receiver error")
             return None
 
         packetSize = len(packet)
-        if packetSize < 16:
+        if packetSize < HEADER_SIZE:
             print("Short packet <16")
             return None
 
-        header = packet[0:16]
-        if bytearray(self.my_address) != header[0:4] and header[0:4] != self.broadcast:
+        view = memoryview(packet)
+        header = self.Header(*struct.unpack_from(HEADER_FORMAT, view, 0))
+        dest = header.dest
+        if dest != self.my_num and dest != BROADCAST_NUM:
             return None
 
-        payload = bytes(packet[16:])
-        if self.encryption_key:
-            cipher = aesio.AES(self.encryption_key,
-                               aesio.MODE_CTR, self.encryption_iv)
-            decrypted_out = bytearray(len(payload))
-            cipher.decrypt_into(payload, decrypted_out)
-            payload = decrypted_out
+        # Relays deliver the same packet several times, keep only the first
+        now = int(time.monotonic() * 1000)
+        duplicate = self.history.seen(header.src, header.id, now)
+        want_ack = header.flags & FLAG_WANT_ACK and dest == self.my_num
+        if duplicate:
+            # Acked again, the sender retries when our ack is lost
+            if want_ack:
+                self.send_ack(header.src, header.id)
+            # Overhearing another relay means ours would add nothing
+            self.tx_queue.cancel(header.src, header.id)
+            if header.src == self.my_num:
+                # Someone relayed our broadcast, which is as good as an ack
+                self.delivered(header.id)
+            return None
+
+        hops = header.flags & FLAG_HOP_LIMIT
+        if self.relay and hops and dest == BROADCAST_NUM:
+            self.tx_queue.add(PRIORITY_RELAY, view, now + self.relay_delay(self.lora.last_snr),
+                              hops=hops - 1)
+
+        if header.channel != self.channel.hash:
+            # Another channel, nothing we could decrypt
+            return None
+        # Decrypted in place, the receive buffer is ours until the next packet
+        self.channel.crypt(packet, packetSize)
+        payload = view[HEADER_SIZE:]
 
         try:
-            decoded_packet = MeshtasticData.decode(payload)
+            # Fields are decoded on first access and bytes fields stay views
+            # into the received packet. Decode the fields loop() reads here,
+            # where a malformed one drops the packet.
+            decoded_packet = MeshtasticData.decode_lazy(payload, copy=False)
+            decoded_packet['portnum']
+            decoded_packet['payload']
+            decoded_packet['request_id']
         except Exception as e:
             print("Failed to decode packet", str(e))
             return 
-        
-        msgID = int.from_bytes(packet[8:12], 'big')
-        msg = self.Message(dst=self.my_address, src=packet[4:8], id=msgID, flags=packet[15],
+
+        # Only acked once it is ours, the sender takes an ack as delivered
+        if want_ack:
+            self.send_ack(header.src, header.id)
+        msg = self.Message(dst=dest, src=header.src, id=header.id, flags=header.flags,
                            s=self.lora.last_snr, rssi=self.lora.last_rssi, tstamp=time.localtime(), packet=decoded_packet)
         return msg
 
-    def send(self, sender, destination, packet, id, hops=3, want_ack=True):
+    def send(self, sender, destination, packet, id, hops=3, want_ack=True, priority=PRIORITY_TEXT):
+        """
+        Build the frame and queue it for transmit() with the given priority.
+        Returns the sent Message, or None if the frame could not be queued.
+        """
         self.led.value = True
-        dest = bytearray(destination)
-        src = bytearray(sender)
-        # msg_id = struct.pack("!I", id)
-        msg_id = bytearray(id)
-        flags = bytearray(struct.pack(
-            "!I", hops | 0b1000 if want_ack else hops & 0b0111))
-
-        packet_bytes = MeshtasticData.encode(packet)
-        payload = bytearray(len(packet_bytes))
-        if self.encryption_key:
-            nonce = src + msg_id
-
-            cipher = aesio.AES(self.encryption_key,
-                               aesio.MODE_CTR, nonce)
-            encrypted_out = bytearray(len(payload))
-            cipher.encrypt_into(packet_bytes, encrypted_out)
-            payload = encrypted_out
-        else:
-            payload = packet_bytes
-        header = bytearray(dest + src + msg_id + flags)
-        if self.lora_config["m"] != "e5":
-            body = bytearray(header) + bytearray(payload)
-            self.lora.send(body)
+        # Header and protobuf body are written straight into the frame buffer
+        frame = self.tx_frame
+        flags = (hops & FLAG_HOP_LIMIT) | (hops << 5 & FLAG_HOP_START)
+        if want_ack:
+            flags |= FLAG_WANT_ACK
+        struct.pack_into("<4s4s4sBBBB", frame, 0, destination, sender, id, flags, self.channel.hash, 0, 0)
+
+        try:
+            length = HEADER_SIZE + MeshtasticData.encode_into(frame, HEADER_SIZE, packet)
+        except minipb.CodecError as e:
+            print("Failed to encode packet", str(e))
+            self.led.value = False
+            return None
+        body = memoryview(frame)[0:length]
+        # Copies of our own packet relayed back to us are dropped on receive
+        dest, src, packet_id = struct.unpack_from("<III", frame, 0)
+        self.history.seen(src, packet_id, int(time.monotonic() * 1000))
+        self.channel.crypt(frame, length)
+        now = int(time.monotonic() * 1000)
+        if self.lora is not None and self.tx_queue.add(priority, body, now):
+            if want_ack:
+                self.acks.add(packet_id, body, self.ack_timeout(length, hops), now)
             self.led.value = False
-            return self.Message(dst=header[4:8], src=self.my_address, id=id, flags=header[15],
+            return self.Message(dst=dest, src=src, id=packet_id, flags=flags,
                                 s=self.lora.last_snr, rssi=self.lora.last_rssi, tstamp=time.localtime(), packet=packet)
         self.led.value = False
         return None
@@ -18,10 +18,15 @@ reverse-engineering of unknown Protobuf messages.
 import re
 import struct
 import io
+from collections import namedtuple
+try:
+    from array import array
+except ImportError:
+    array = None
 
 __all__ = [
     'BadFormatString', 'CodecError', 'EndOfMessage',
-    'Wire', 'RawWire',
+    'Wire', 'RawWire', 'MessageView', 'Decoder',
     'encode', 'decode', 'encode_raw', 'decode_raw',
 ]
 
@@ -64,6 +69,255 @@ else:
     def _get_length_of_match(m):
         return m.end()
 
+# Exceptions raised when a compiled decoder runs off the end of its buffer
+_TRUNCATED = (IndexError, getattr(struct, 'error', ValueError))
+
+# array typecodes of the vint types packed repeated fields are decoded into,
+# fixed-width types use their own letter
+_VINT_ARRAY_TYPES = {'T': 'Q', 't': 'q', 'z': 'q'}
+_FIXED_TYPES = 'iIqQfd'
+
+
+def _array_typecode(wire, field_type):
+    """
+    Typecode of the array.array a packed repeated field of field_type is
+    decoded into, or None if it is decoded into a tuple.
+    """
+    if array is None:
+        return None
+    if field_type in _FIXED_TYPES:
+        return field_type
+    if field_type == 't' and wire._vint_2sc_max_bits > 64:
+        return None
+    return _VINT_ARRAY_TYPES.get(field_type)
+
+
+def _to_array(typecode, values):
+    try:
+        return array(typecode, values)
+    except OverflowError:
+        raise CodecError('Packed value does not fit array type {0}'.format(typecode))
+
+
+def _put_vint(buf, pos, number):
+    """
+    Write a vint into buf at pos.
+    Returns the position right after it.
+    Used by the compiled encoders.
+    """
+    assert number >= 0, 'number is less than 0'
+    # 1 and 2 byte fast paths (field headers, lengths, flags, portnums)
+    if number < 0x80:
+        buf[pos] = number
+        return pos + 1
+    if number < 0x4000:
+        buf[pos] = (number & 0x7f) | 0x80
+        buf[pos + 1] = number >> 7
+        return pos + 2
+    while number > 0x7f:
+        buf[pos] = (number & 0x7f) | 0x80
+        number >>= 7
+        pos += 1
+    buf[pos] = number
+    return pos + 1
+
+
+def _put_uvint(buf, pos, number):
+    """
+    _put_vint() without the sign check, for numbers that cannot be
+    negative (lengths, masked and zigzag values) and for trusted wires.
+    """
+    if number < 0x80:
+        buf[pos] = number
+        return pos + 1
+    if number < 0x4000:
+        buf[pos] = (number & 0x7f) | 0x80
+        buf[pos + 1] = number >> 7
+        return pos + 2
+    while number > 0x7f:
+        buf[pos] = (number & 0x7f) | 0x80
+        number >>= 7
+        pos += 1
+    buf[pos] = number
+    return pos + 1
+
+
+def _put_bytes(buf, pos, data):
+    """
+    Copy data into buf at pos.
+    Returns the position right after it.
+    Used by the compiled encoders.
+    """
+    end = pos + len(data)
+    # slice assignment would silently grow a bytearray
+    if end > len(buf):
+        raise IndexError('buffer too small')
+    buf[pos:end] = data
+    return end
+
+
+# Smallest number that needs a vint of 3, 4, ... 10 bytes
+_VINT_LIMITS = tuple(1 << (7 * size) for size in range(3, 11))
+
+# Scratch byte the stream decoder reads vints into, so reading a byte
+# allocates nothing
+_VINT_BYTE = bytearray(1)
+
+
+def _vint_size(number):
+    """
+    Number of bytes the vint encoding of a number takes.
+    Used by the compiled encoders and sizers.
+    """
+    assert number >= 0, 'number is less than 0'
+    if number < 0x80:
+        return 1
+    if number < 0x4000:
+        return 2
+    size = 3
+    for limit in _VINT_LIMITS:
+        if number < limit:
+            return size
+        size += 1
+    while number >> (7 * size):
+        size += 1
+    return size
+
+
+if hasattr(str, 'isascii'):
+    def _utf8_size(text):
+        """
+        Length of the UTF-8 encoding of a string, without encoding it.
+        """
+        if text.isascii():
+            return len(text)
+        return _utf8_count(text)
+else:
+    def _utf8_size(text):
+        """
+        Length of the UTF-8 encoding of a string, without encoding it.
+        """
+        return _utf8_count(text)
+
+
+def _utf8_count(text):
+    size = len(text)
+    for char in text:
+        code = ord(char)
+        if code > 0x7f:
+            size += 1 if code < 0x800 else (2 if code < 0x10000 else 3)
+    return size
+
+
+def _close_length(buf, start, end):
+    """
+    Fill in the length prefix of a length-delimited value that was written
+    right after the single byte reserved for the prefix at start.
+    If the length needs a longer vint, the value is moved up to make room.
+    Returns the position right after the value.
+    Used by the compiled encoders.
+    """
+    length = end - start - 1
+    if length < 0x80:
+        buf[start] = length
+        return end
+    size = _vint_size(length)
+    _put_bytes(buf, start + size, bytes(buf[start + 1:end]))
+    _put_uvint(buf, start, length)
+    return end + size - 1
+
+
+def _room(codec, obj, size, prefix):
+    """
+    Buffer size that holds obj encoded by codec, after an encoder ran out
+    of a buffer of the given size. prefix is 1 if the message is written
+    after a reserved length byte, whose vint may need to grow.
+    Raises CodecError if the buffer was big enough after all, in which
+    case the IndexError did not come from the buffer.
+    Used by the retry loops of encode() and write_delimited().
+    """
+    needed = codec.size(obj)
+    if prefix:
+        needed += _vint_size(needed)
+    if needed <= size:
+        raise CodecError('Object could not be encoded')
+    return needed
+
+
+def _vint_at(buf, pos):
+    """
+    Decode a vint starting at buf[pos].
+    Returns the decoded number and the position right after it.
+    Used by the compiled decoders.
+    """
+    # 1 and 2 byte fast paths (field headers, lengths, flags, portnums)
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    result = b & 0x7f
+    b = buf[pos + 1]
+    if b < 0x80:
+        return result | (b << 7), pos + 2
+    result |= (b & 0x7f) << 7
+    shift = 14
+    pos += 2
+    while 1:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _vint_reader(max_bytes):
+    """
+    Returns a version of _vint_at() that raises CodecError as soon as a
+    vint runs past max_bytes bytes.
+    Used by the compiled decoders of a Wire with a vint length limit.
+    """
+    max_shift = 7 * (max_bytes - 1)
+
+    def vint_at(buf, pos):
+        b = buf[pos]
+        if b < 0x80:
+            return b, pos + 1
+        result = b & 0x7f
+        shift = 7
+        pos += 1
+        while 1:
+            if shift > max_shift:
+                raise CodecError('Vint is longer than {0} bytes'.format(max_bytes))
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result, pos
+            shift += 7
+    return vint_at
+
+
+def _skip_at(buf, pos, wire_type, vint_at=_vint_at):
+    """
+    Skip over the value of a field the schema does not know about.
+    Returns the position right after the value.
+    Used by the compiled decoders.
+    """
+    if wire_type == 0:
+        if vint_at is not _vint_at:
+            return vint_at(buf, pos)[1]
+        while buf[pos] & 0x80:
+            pos += 1
+        return pos + 1
+    elif wire_type == 1:
+        return pos + 8
+    elif wire_type == 2:
+        length, pos = vint_at(buf, pos)
+        return pos + length
+    elif wire_type == 5:
+        return pos + 4
+    raise CodecError('Unsupported wire type {0}'.format(wire_type))
+
 
 class Wire(object):
     # Field types
@@ -92,7 +346,19 @@ class Wire(object):
     # The default maximum length of a negative vint encoded in 2's complement (in bits)
     VINT_MAX_BITS = 64
 
-    def __init__(self, fmt):
+    def __init__(self, fmt, trusted=False):
+        self._codec = None
+        self._trusted = trusted
+        self._record_name = None
+        self._view_codec = None
+        self._projections = {}
+        # encode() works in here and copies the result out
+        self._scratch = bytearray(64)
+        # decode limits, see set_limits()
+        self._max_depth = None
+        self._max_fields = None
+        self._max_bytes = None
+        self._vint_at = _vint_at
         self._vint_2sc_max_bits = 0
         self._vint_2sc_mask = 0
         self.vint_2sc_max_bits = self.__class__.VINT_MAX_BITS
@@ -104,6 +370,29 @@ class Wire(object):
             self._fmt = self._parse_kvfmt(fmt)
             self._kv_fmt = True
 
+        if trusted:
+            self.compile()
+
+    @property
+    def trusted(self):
+        """
+        True if the data this object encodes and decodes is known to be
+        valid, e.g. messages we produced ourselves. Trusted objects always
+        use compiled codecs, which then skip wire type, required field and
+        parameter checks. Malformed data gives undefined results instead
+        of errors, but valid data gives the same results as without.
+        Limits from set_limits() are still enforced.
+        """
+        return self._trusted
+
+    @trusted.setter
+    def trusted(self, trusted):
+        self._trusted = trusted
+        self._view_codec = None
+        self._projections = {}
+        if trusted or self._codec is not None:
+            self.compile(self._record_name)
+
     @property
     def vint_2sc_max_bits(self):
         """
@@ -115,6 +404,44 @@ class Wire(object):
     def vint_2sc_max_bits(self, bits):
         self._vint_2sc_max_bits = bits
         self._vint_2sc_mask = (1 << bits) - 1
+        # The compiled codecs have the mask baked in
+        self._view_codec = None
+        self._projections = {}
+        if self._codec is not None:
+            self.compile(self._record_name)
+
+    def set_limits(self, max_depth=None, max_fields=None, max_vint_bytes=None, max_bytes=None):
+        """
+        Bound the work decoding untrusted data can take. Messages that go
+        over a limit are rejected with CodecError as soon as it is hit:
+            - max_depth: how deep nested structures may be decoded, the
+              top level message being depth 1
+            - max_fields: number of fields in any single (nested) message
+            - max_vint_bytes: length of any vint (10 is enough for 64 bits)
+            - max_bytes: size of the whole message
+        None leaves that limit off, which is the default for all of them.
+        The limits are enforced by the compiled codecs, so decode() uses
+        them from now on even if compile() has not been called.
+        Returns the Wire object itself so it can be chained with the
+        constructor at import time.
+        """
+        self._max_depth = max_depth
+        self._max_fields = max_fields
+        self._max_bytes = max_bytes
+        self._vint_at = _vint_at if max_vint_bytes is None else _vint_reader(max_vint_bytes)
+        self._view_codec = None
+        self._projections = {}
+        if self._codec is not None:
+            self.compile(self._record_name)
+        return self
+
+    @property
+    def limited(self):
+        """
+        True if any decode limit has been set with set_limits().
+        """
+        return (self._max_depth is not None or self._max_fields is not None
+                or self._max_bytes is not None or self._vint_at is not _vint_at)
 
     @property
     def kvfmt(self):
@@ -123,6 +450,40 @@ class Wire(object):
         """
         return self._kv_fmt
 
+    @property
+    def compiled(self):
+        """
+        True if compile() has been called on the object.
+        """
+        return self._codec is not None
+
+    @property
+    def record(self):
+        """
+        The namedtuple class messages decode into, or None if compile()
+        was not asked for records.
+        """
+        return None if self._codec is None else self._codec._record
+
+    def compile(self, record=None):
+        """
+        Turn the parsed schema into specialized encode/decode callables.
+        After this, encode() and decode() no longer walk the format list
+        or dispatch on type letters for every message.
+        In key-value mode, pass a class name as record to decode messages
+        into namedtuples with one slot per field instead of dicts. Nested
+        structures get a namedtuple of their own, named after the record
+        and the field (e.g. Node_user). encode() accepts both the records
+        and dicts.
+        Returns the Wire object itself so it can be chained with the
+        constructor at import time.
+        """
+        self._codec = _Codec(self, self._fmt, record=record)
+        self._record_name = record
+        self._view_codec = None
+        self._projections = {}
+        return self
+
     def _parse_kvfmt(self, fmtlist):
         """
         Similar to _parse() but for key-value format lists.
@@ -186,6 +547,7 @@ class Wire(object):
                 parsed_field['subcontent'] = self._parse_kvfmt(fmt)
                 field_id += 1
             parsed_list.append(parsed_field)
+        self._add_headers(parsed_list)
         return parsed_list
 
     def _parse(self, fmtstr):
@@ -199,6 +561,7 @@ class Wire(object):
                       Needs to be an empty string when there's none.
             - subcontent: Optional. Used for nested structures. (field_type must be `a' when this is defined)
             - repeat: Optional. Copy this field specified number of times to consecutive indices.
+            - headers: Encoded header of every field id the field covers. (not present on skip fields)
         """
         def _match_brace(string, start_pos, pair='[]'):
             """Pairing brackets (used internally in _parse method)"""
@@ -281,9 +644,31 @@ class Wire(object):
                     'Invalid token on position {0}'.format(ptr)
                 )
 
+        self._add_headers(parsed_list)
+
         # all set
         return parsed_list
 
+    def _add_headers(self, parsed_list):
+        """
+        Precompute the encoded field headers of a parsed format list.
+        Stored as a tuple under the `headers' key, one entry per field id
+        the field covers. Placeholder fields get none.
+        Called internally at the end of _parse() and _parse_kvfmt()
+        """
+        wire_types = self.__class__.FIELD_WIRE_TYPE
+        for parsed in parsed_list:
+            field_type = parsed['field_type']
+            if field_type == 'x':
+                continue
+            # Packed repeating field always has a str-like header
+            wire_type = wire_types['a'] if parsed['prefix'] == '#' else wire_types[field_type]
+            field_id_start = parsed['field_id']
+            parsed['headers'] = tuple(
+                self._encode_header(wire_type, field_id)
+                for field_id in range(field_id_start, field_id_start + parsed.get('repeat', 1))
+            )
+
     def encode(self, *stuff):
         """
         Encode given objects to binary wire format.
@@ -293,12 +678,49 @@ class Wire(object):
         Otherwise, the method accepts multiple objects (like Struct.pack())
         and all objects will be encoded sequentially.
         """
+        if self._codec is not None:
+            obj = stuff[0] if self._kv_fmt else stuff
+            buf = self._scratch
+            try:
+                end = self._codec.encode_into(obj, buf, 0)
+            except IndexError:
+                # Too small, encode once more into a buffer of the exact size
+                buf = self._scratch = bytearray(_room(self._codec, obj, len(buf), 0))
+                end = self._codec.encode_into(obj, buf, 0)
+            return bytes(memoryview(buf)[:end])
         if self._kv_fmt:
             result = self._encode_wire(stuff[0])
         else:
             result = self._encode_wire(stuff)
         return result.getvalue()
 
+    def encode_into(self, buf, offset, *stuff):
+        """
+        Encode given objects straight into a bytearray (or a writable
+        memoryview) starting at offset, and return the number of bytes
+        written. Takes the objects the same way encode() does.
+        Raises CodecError if buf is too small to hold the message.
+        """
+        codec = self._codec
+        if codec is None:
+            codec = self.compile()._codec
+        try:
+            end = codec.encode_into(stuff[0] if self._kv_fmt else stuff, buf, offset)
+        except IndexError:
+            raise CodecError('Buffer too small to hold the message')
+        return end - offset
+
+    def encoded_size(self, *stuff):
+        """
+        Return the exact length of the binary wire encode() would produce
+        for given objects, without encoding them.
+        Takes the objects the same way encode() does.
+        """
+        codec = self._codec
+        if codec is None:
+            codec = self.compile()._codec
+        return codec.size(stuff[0] if self._kv_fmt else stuff)
+
     def _encode_wire(self, stuff, fmtable=None):
         """
         Encode a list to binary wire using fmtable
@@ -328,20 +750,12 @@ class Wire(object):
                                          fmt['name'] if self._kv_fmt else field_id))
                 prefix = fmt['prefix']
                 subcontent = fmt.get('subcontent')
-                wire_type = self.__class__.FIELD_WIRE_TYPE[fmt['field_type']]
 
                 # Skip blank field (placeholder)
                 if field_type == 'x':
                     continue
 
-                # Packed repeating field always has a str-like header
-                if prefix == '#':
-                    encoded_header = self._encode_header(
-                        self.__class__.FIELD_WIRE_TYPE['a'],
-                        field_id
-                    )
-                else:
-                    encoded_header = self._encode_header(wire_type, field_id)
+                encoded_header = fmt['headers'][field_id - field_id_start]
 
                 # Empty required field
                 if prefix == '*' and field_data == None:
@@ -459,6 +873,10 @@ class Wire(object):
         """
 
         assert number >= 0, 'number is less than 0'
+        if number < 0x80:
+            return bytes((number, ))
+        if number < 0x4000:
+            return bytes(((number & 0x7f) | 0x80, number >> 7))
         result = bytearray()
         while 1:
             tmp = number & 0x7f
@@ -479,20 +897,240 @@ class Wire(object):
         result += string
         return result
 
-    def decode(self, data):
-        """Decode given binary wire data to Python data types."""
+    def decode(self, data, copy=True, fields=None):
+        """
+        Decode given binary wire data to Python data types.
+        Packed repeated fields of numbers are decoded into an array.array
+        (where the array module is available), other repeated fields into
+        tuples.
+        Pass copy=False to get bytes fields as memoryview slices of data
+        instead of copies. The slices are only valid for as long as the
+        caller leaves data untouched.
+        In key-value mode, fields may list the names of the only fields
+        to decode, using dots for nested fields (e.g. 'user.id'). All
+        other fields are skipped on the wire and left out of the result.
+        """
 
         # Tested:
         #   types: z, T, a
         #   nested_structure
         #   repeated
+        if fields is not None:
+            codec = self._projection(fields, copy)
+        elif copy:
+            codec = self._codec
+            if codec is None and self.limited:
+                codec = self.compile()._codec
+        else:
+            codec = self._zero_copy_codec()
+        if codec is not None:
+            if hasattr(data, 'read'):
+                data = data.read()
+            self._check_size(data)
+            try:
+                return codec.decode(memoryview(data), 0, len(data))
+            except _TRUNCATED:
+                raise CodecError('Unexpected end of message')
+
         if not hasattr(data, 'read'):
             data = io.BytesIO(data)
 
-        if self._kv_fmt:
-            return dict(self._decode_wire(data))
-        else:
-            return tuple(self._decode_wire(data))
+        try:
+            if self._kv_fmt:
+                return dict(self._decode_wire(data))
+            else:
+                return tuple(self._decode_wire(data))
+        except OverflowError:
+            # a length too big to even try to read
+            raise CodecError('Length prefix is out of range')
+        except AssertionError as e:
+            # the interpreted decoder checks the wire data with asserts
+            raise CodecError(str(e))
+
+    def decode_many(self, buffers, copy=True, fields=None):
+        """
+        Decode a batch of buffers, e.g. everything drained from a receive
+        queue, taking copy and fields like decode().
+        A bad message does not stop the rest from being decoded. This is
+        a convenience for collecting the errors, not a faster path: each
+        buffer costs the same as a decode() call.
+        Returns a list with one result per buffer (None for the ones that
+        failed) and a list of (index, exception) pairs for the failures.
+        """
+        results = []
+        errors = []
+        append = results.append
+        index = 0
+        for data in buffers:
+            try:
+                append(self.decode(data, copy=copy, fields=fields))
+            except (CodecError, TypeError, ValueError) as e:
+                # ValueError also covers bad UTF-8 in string fields
+                append(None)
+                errors.append((index, e))
+            index += 1
+        return results, errors
+
+    def decoder(self, copy=True, max_length=None):
+        """
+        Return a Decoder that decodes a stream of length-delimited
+        messages of this type fed to it in arbitrary chunks.
+        max_length defaults to the max_bytes limit from set_limits().
+        """
+        return Decoder(self, copy, max_length)
+
+    def iter_delimited(self, fileobj, chunk_size=256):
+        """
+        Generator that reads length-delimited messages from a file-like
+        object and yields them decoded, one at a time.
+        The file is read in chunks of chunk_size bytes into a single
+        buffer that is reused for the whole stream.
+        Raises CodecError if the stream ends in the middle of a message,
+        or the error of a message that could not be decoded once the
+        messages before it have been yielded.
+        """
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        # bytes fields must be copied out since buf gets overwritten
+        decoder = self.decoder()
+        readinto = getattr(fileobj, 'readinto', None)
+        while 1:
+            if readinto is not None:
+                count = readinto(buf)
+                chunk = view[:count] if count else None
+            else:
+                chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            for message in decoder.feed(chunk):
+                yield message
+            if decoder.errors:
+                raise decoder.errors[0]
+        if decoder.partial:
+            raise CodecError('Stream ends in the middle of a message')
+
+    def write_delimited(self, fileobj, objs, chunk_size=256):
+        """
+        Write objects from an iterable (e.g. a generator) to a file-like
+        object as length-delimited messages. In key-value mode each object
+        is a dict or a record, otherwise a tuple of the field values.
+        Messages are packed into a single reusable buffer and written out
+        whenever the next one does not fit, so the file sees few large
+        writes. Returns the number of bytes written.
+        """
+        codec = self._codec
+        if codec is None:
+            codec = self.compile()._codec
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        pos = 0
+        written = 0
+        for obj in objs:
+            while 1:
+                try:
+                    # one byte reserved for the length, like nested fields
+                    pos = _close_length(buf, pos, codec.encode_into(obj, buf, pos + 1))
+                    break
+                except IndexError:
+                    if pos:
+                        fileobj.write(view[:pos])
+                        written += pos
+                        pos = 0
+                    else:
+                        buf = bytearray(_room(codec, obj, len(buf), 1))
+                        view = memoryview(buf)
+        if pos:
+            fileobj.write(view[:pos])
+            written += pos
+        return written
+
+    def decode_lazy(self, data, copy=True):
+        """
+        Return a MessageView over data instead of decoding it.
+        The wire is scanned once for field offsets and every field is only
+        decoded when it is first accessed. Nested messages are returned as
+        views too. The view keeps a reference to data, so the caller must
+        leave data untouched while the view is in use.
+        """
+        codec = self._codec if copy else self._zero_copy_codec()
+        if codec is None:
+            codec = self.compile()._codec
+        if hasattr(data, 'read'):
+            data = data.read()
+        self._check_size(data)
+        try:
+            return MessageView(codec, memoryview(data), 0, len(data))
+        except _TRUNCATED:
+            raise CodecError('Unexpected end of message')
+
+    def _check_size(self, data):
+        """
+        Reject data that is over the max_bytes limit before decoding it.
+        """
+        if self._max_bytes is not None and len(data) > self._max_bytes:
+            raise CodecError('Message size {0} is over the limit of {1} bytes'.format(
+                len(data), self._max_bytes))
+
+    def _projection(self, fields, copy):
+        """
+        Compiled codec that only knows about the given fields.
+        Built on first use and kept for later calls with the same fields.
+        """
+        fields = tuple(fields)
+        codec = self._projections.get((fields, copy))
+        if codec is not None:
+            return codec
+        if not self._kv_fmt:
+            raise BadFormatString('Decoding selected fields requires a key-value format list.')
+
+        # name -> None (whole field) or a dict of selected nested fields
+        selection = {}
+        for path in fields:
+            node = selection
+            names = path.split('.')
+            for name in names[:-1]:
+                if name in node and node[name] is None:
+                    break
+                node = node.setdefault(name, {})
+            else:
+                node[names[-1]] = None
+
+        codec = _Codec(self, self._select(self._fmt, selection), copy, self._record_name)
+        self._projections[(fields, copy)] = codec
+        return codec
+
+    def _select(self, fmtable, selection):
+        """
+        Return the parts of a parsed format list picked by a selection
+        built in _projection().
+        """
+        selected = []
+        for fmt in fmtable:
+            name = fmt['name']
+            if name not in selection:
+                continue
+            subselection = selection[name]
+            if subselection is not None:
+                if 'subcontent' not in fmt:
+                    raise BadFormatString('Field "{0}" is not a nested structure'.format(name))
+                fmt = dict(fmt)
+                fmt['subcontent'] = self._select(fmt['subcontent'], subselection)
+            selected.append(fmt)
+        if len(selected) != len(selection):
+            known = [fmt['name'] for fmt in fmtable]
+            for name in selection:
+                if name not in known:
+                    raise BadFormatString('Unknown field "{0}"'.format(name))
+        return selected
+
+    def _zero_copy_codec(self):
+        """
+        Compiled codec that hands out memoryview slices for bytes fields.
+        Built on first use since most schemas never need it.
+        """
+        if self._view_codec is None:
+            self._view_codec = _Codec(self, self._fmt, False, self._record_name)
+        return self._view_codec
 
     def _decode_header(self, buf):
         """
@@ -512,16 +1150,24 @@ class Wire(object):
         Raises EndOfMessage if there is no or only partial data available.
         Called internally in decode() method.
         """
-        ctr = 0
-        result = 0
-        tmp = bytearray(1)
-        partial = False
+        tmp = _VINT_BYTE
+        readinto = buf.readinto
+        # 1 and 2 byte fast paths (field headers, lengths, flags, portnums)
+        if not readinto(tmp):
+            raise EndOfMessage(False)
+        first = tmp[0]
+        if first < 0x80:
+            return first
+        if not readinto(tmp):
+            raise EndOfMessage(True)
+        if tmp[0] < 0x80:
+            return (first & 0x7f) | (tmp[0] << 7)
+
+        ctr = 2
+        result = (first & 0x7f) | ((tmp[0] & 0x7f) << 7)
         while 1:
-            count = buf.readinto(tmp)
-            if count == 0:
-                raise EndOfMessage(partial)
-            else:
-                partial = True
+            if not readinto(tmp):
+                raise EndOfMessage(True)
             result |= (tmp[0] & 0x7f) << (7 * ctr)
             if not (tmp[0] >> 7): break
             ctr += 1
@@ -701,7 +1347,15 @@ class Wire(object):
             result['data'] = result_wire.getvalue()
             return result
 
-        decoded_raw = tuple(self._break_down(buf))
+        # bucket the raw fields by field id in a single pass
+        decoded_raw = {}
+        for field in self._break_down(buf):
+            bucket = decoded_raw.get(field['id'])
+            if bucket is None:
+                decoded_raw[field['id']] = [field]
+            else:
+                bucket.append(field)
+
         if not subfmt:
             subfmt = self._fmt
 
@@ -722,7 +1376,7 @@ class Wire(object):
                     continue
 
                 # get all the data attached on the given field
-                fields = tuple(x for x in decoded_raw if x['id'] == field_id)
+                fields = decoded_raw.get(field_id, ())
 
                 # raise error if a required field is empty
                 if field_prefix == '*' and len(fields) == 0:
@@ -741,7 +1395,10 @@ class Wire(object):
 
                 # packed repeated field
                 elif field_prefix == '#':
-                    if len(fields) > 1:
+                    typecode = _array_typecode(self, field_type)
+                    if len(fields) == 0:
+                        fields = ({'wire_type': 2, 'data': b''}, )
+                    elif len(fields) > 1:
                         fields = (_concat_fields(fields), )
                     if fields[0]['wire_type'] != self.__class__.FIELD_WIRE_TYPE['a']:
                         raise CodecError('Packed repeated field {0} has wire type other than str'.format(
@@ -757,6 +1414,8 @@ class Wire(object):
                         self._decode_field(field_type, f, subcontent)
                         for f in unpacked_field
                     )
+                    if typecode is not None:
+                        field_decoded = _to_array(typecode, field_decoded)
 
                 # not a repeated field but has multiple data in one field
                 elif len(fields) > 1:
@@ -823,6 +1482,46 @@ class RawWire(Wire):
 
         return tuple(self._break_down(data))
 
+    def iter_fields(self, data):
+        '''
+        Generator version of decode() that yields one field at a time as a
+        (field id, wire type, value) tuple, so the caller can stop as soon
+        as it has seen what it needs.
+        Vints (wire type 0) are yielded as unsigned integers. All other
+        values are yielded as memoryview slices of data without copying,
+        i.e. 8 bytes for wire type 1, 4 bytes for wire type 5 and the
+        payload for wire type 2.
+        '''
+        if hasattr(data, 'read'):
+            data = data.read()
+        buf = memoryview(data)
+        end = len(buf)
+        pos = 0
+        tag = 0
+        try:
+            while pos < end:
+                tag, pos = _vint_at(buf, pos)
+                wire_type = tag & 7
+                if wire_type == 0:
+                    value, pos = _vint_at(buf, pos)
+                else:
+                    start = pos
+                    if wire_type == 2:
+                        length, start = _vint_at(buf, pos)
+                        pos = start + length
+                    elif wire_type == 1:
+                        pos += 8
+                    elif wire_type == 5:
+                        pos += 4
+                    else:
+                        raise CodecError('Unsupported wire type {0}'.format(wire_type))
+                    if pos > end:
+                        raise IndexError
+                    value = buf[start:pos]
+                yield tag >> 3, wire_type, value
+        except _TRUNCATED:
+            raise CodecError('Unexpected end of message while decoding field {0}'.format(tag >> 3))
+
     def encode(self, stuff):
         '''
         Encode the output of decode() back to binary wire format
@@ -858,6 +1557,880 @@ class RawWire(Wire):
         return encoded.getvalue()
 
 
+class _Codec(object):
+    '''
+    A schema compiled down to per-field encode/decode callables.
+    Built by Wire.compile(). Nested structures get a _Codec of their own.
+    Decoders work on a memoryview with an integer cursor. With copy=False
+    bytes fields are returned as memoryview slices of the input.
+    If record is a class name, messages decode into a namedtuple of that
+    name instead of a dict, and nested structures into namedtuples named
+    after their field. Decoded values are then stored by slot.
+    The decode limits of the wire are baked in. Nesting depth is known
+    from the schema, so structures nested too deep get a handler that
+    rejects them instead of a per-message depth count.
+    '''
+    def __init__(self, wire, fmtable, copy=True, record=None, depth=1):
+        kv = wire.kvfmt
+        if record is not None and not kv:
+            raise BadFormatString('Record classes require a key-value format list.')
+        # decoded messages are kept in a dict only in plain key-value mode
+        self._kv = kv and record is None
+        # (key, put, measure, required, label) in schema order
+        self._enc = []
+        # field id -> handler
+        self._dec = {}
+        # key -> (field_id, kind, sub, slot), used by merge() and MessageView
+        self._fields = {}
+        # fields that need attention after the wire is consumed
+        self._post = []
+        self._vint_at = wire._vint_at
+        self._max_fields = wire._max_fields
+        self._max_depth = wire._max_depth
+        self._trusted = wire._trusted
+        # too deep to be decoded under the max_depth limit
+        self._deep = wire._max_depth is not None and depth > wire._max_depth
+        keys = []
+
+        slot = 0
+        for fmt in fmtable:
+            field_type = fmt['field_type']
+            # placeholders take neither a parameter nor a result slot
+            if field_type == 'x':
+                continue
+            prefix = fmt['prefix']
+            subcontent = fmt.get('subcontent')
+            if subcontent:
+                sub_record = None if record is None else record + '_' + fmt['name']
+                sub = _Codec(wire, subcontent, copy, sub_record, depth + 1)
+            else:
+                sub = None
+            field_id_start = fmt['field_id']
+            for field_id in range(field_id_start, field_id_start + fmt.get('repeat', 1)):
+                key = fmt['name'] if kv else slot
+                header = fmt['headers'][field_id - field_id_start]
+                self._compile_field(wire, key, key if self._kv else slot,
+                                    field_id, field_type, prefix, sub, header, copy)
+                slot += 1
+                keys.append(key)
+
+        self._keys = tuple(keys)
+        if self._kv:
+            self._blank = dict((key, None) for key in keys)
+        else:
+            self._blank = [None] * slot
+
+        if record is None:
+            self._record = None
+            self._make = None if kv else tuple
+        else:
+            self._record = record_class = namedtuple(record, keys)
+            self._make = lambda values: record_class(*values)
+            # records can be encoded too, their fields are found by slot
+            self._enc_slots = [(slot, ) + step[1:] for slot, step in enumerate(self._enc)]
+
+        if self._trusted:
+            self.encode_into = self._encode_into_trusted
+
+    def _compile_field(self, wire, key, slot, field_id, field_type, prefix, sub, header, copy):
+        """
+        Build the encoder step and decoder handler of a single field.
+        The encoder looks the value up by key, the decoder stores it by
+        slot.
+        """
+        wire_type = wire.FIELD_WIRE_TYPE[field_type]
+        write = self._writer(wire, field_type, sub)
+        size = self._sizer(wire, field_type, sub)
+        read = self._reader(wire, field_type, sub, copy)
+
+        if prefix == '+':
+            put = _enc_repeated(header, write)
+            measure = _size_repeated(len(header), size)
+            if self._trusted:
+                handler = _dec_repeated_trusted(slot, read)
+            else:
+                handler = _dec_repeated(slot, wire_type, read)
+            kind = prefix
+            self._post.append((slot, kind, None))
+        elif prefix == '#':
+            typecode = _array_typecode(wire, field_type)
+            if typecode is None:
+                put = _enc_packed(header, write)
+                measure = _size_packed(len(header), size)
+                handler = _dec_packed(slot, field_id, read, self._vint_at)
+            elif field_type in _FIXED_TYPES:
+                # whole runs of values go through a single struct call
+                put = _enc_packed_fixed(header, field_type)
+                measure = _size_packed_fixed(len(header), field_type)
+                handler = _dec_packed_fixed(slot, field_id, field_type, self._vint_at)
+            else:
+                put = _enc_packed(header, write)
+                measure = _size_packed(len(header), size)
+                handler = _dec_packed_array(slot, field_id, field_type, read, typecode, self._vint_at)
+            kind = prefix
+            self._post.append((slot, kind, typecode))
+        elif sub is not None:
+            put = _enc_plain(header, write)
+            measure = _size_plain(len(header), size)
+            if sub._deep:
+                handler = _dec_too_deep(wire._max_depth)
+            else:
+                handler = _dec_nested(slot, sub)
+            kind = '['
+        else:
+            put = _enc_plain(header, write)
+            measure = _size_plain(len(header), size)
+            if self._trusted:
+                handler = _dec_plain_trusted(slot, read)
+            else:
+                handler = _dec_plain(slot, wire_type, read)
+            kind = ''
+        if prefix == '*' and not self._trusted:
+            self._post.append((slot, prefix, None))
+
+        self._enc.append((key, put, measure, prefix == '*', key if self._kv else field_id))
+        self._dec[field_id] = handler
+        self._fields[key] = (field_id, kind, sub, slot)
+
+    @staticmethod
+    def _writer(wire, field_type, sub):
+        """
+        Returns a callable that writes a bare value into a buffer at a
+        position and returns the position after it.
+        """
+        if sub is not None:
+            def write(buf, pos, value):
+                return _close_length(buf, pos, sub.encode_into(value, buf, pos + 1))
+        elif field_type == 'a':
+            def write(buf, pos, value):
+                return _put_bytes(buf, _put_uvint(buf, pos, len(value)), value)
+        elif field_type == 'U':
+            def write(buf, pos, value):
+                value = value.encode('utf-8')
+                return _put_bytes(buf, _put_uvint(buf, pos, len(value)), value)
+        elif field_type == 'T':
+            write = _put_uvint if wire._trusted else _put_vint
+        elif field_type == 't':
+            mask = wire._vint_2sc_mask
+            def write(buf, pos, value):
+                return _put_uvint(buf, pos, value & mask)
+        elif field_type == 'z':
+            def write(buf, pos, value):
+                return _put_uvint(buf, pos, ~(value << 1) if value < 0 else value << 1)
+        elif field_type == 'b':
+            put_vint = _put_uvint if wire._trusted else _put_vint
+            def write(buf, pos, value):
+                return put_vint(buf, pos, int(value))
+        else:
+            fmt = '<' + field_type
+            size = struct.calcsize(fmt)
+            pack_into = struct.pack_into
+            def write(buf, pos, value):
+                end = pos + size
+                if end > len(buf):
+                    raise IndexError('buffer too small')
+                pack_into(fmt, buf, pos, value)
+                return end
+        return write
+
+    @staticmethod
+    def _sizer(wire, field_type, sub):
+        """
+        Returns a callable that computes the encoded size of a bare value.
+        """
+        if sub is not None:
+            def size(value):
+                length = sub.size(value)
+                return _vint_size(length) + length
+        elif field_type == 'a':
+            def size(value):
+                length = len(value)
+                return _vint_size(length) + length
+        elif field_type == 'U':
+            def size(value):
+                length = _utf8_size(value)
+                return _vint_size(length) + length
+        elif field_type == 'T':
+            size = _vint_size
+        elif field_type == 't':
+            mask = wire._vint_2sc_mask
+            def size(value):
+                return _vint_size(value & mask)
+        elif field_type == 'z':
+            def size(value):
+                return _vint_size(~(value << 1) if value < 0 else value << 1)
+        elif field_type == 'b':
+            def size(value):
+                return _vint_size(int(value))
+        else:
+            fixed = struct.calcsize('<' + field_type)
+            def size(value):
+                return fixed
+        return size
+
+    @staticmethod
+    def _reader(wire, field_type, sub, copy):
+        """
+        Returns a callable that reads a bare value at a position and
+        returns it together with the position after it.
+        """
+        vint_at = wire._vint_at
+        if sub is not None:
+            if sub._deep:
+                def read(buf, pos):
+                    raise _too_deep(sub._max_depth)
+            else:
+                def read(buf, pos):
+                    length, pos = vint_at(buf, pos)
+                    end = pos + length
+                    return sub.decode(buf, pos, end), end
+        elif field_type == 'a' and copy:
+            def read(buf, pos):
+                length, pos = vint_at(buf, pos)
+                end = pos + length
+                return bytes(buf[pos:end]), end
+        elif field_type == 'a':
+            def read(buf, pos):
+                length, pos = vint_at(buf, pos)
+                end = pos + length
+                return buf[pos:end], end
+        elif field_type == 'U':
+            def read(buf, pos):
+                length, pos = vint_at(buf, pos)
+                end = pos + length
+                return str(buf[pos:end], 'utf-8'), end
+        elif field_type == 'T':
+            read = vint_at
+        elif field_type == 't':
+            sign = wire._vint_2sc_max_bits - 1
+            mask = wire._vint_2sc_mask
+            def read(buf, pos):
+                number, pos = vint_at(buf, pos)
+                if (number >> sign) & 1:
+                    number = ~(~number & mask)
+                return number, pos
+        elif field_type == 'z':
+            def read(buf, pos):
+                number, pos = vint_at(buf, pos)
+                return ~(number >> 1) if number & 1 else number >> 1, pos
+        elif field_type == 'b':
+            def read(buf, pos):
+                number, pos = vint_at(buf, pos)
+                return number != 0, pos
+        else:
+            fmt = '<' + field_type
+            size = struct.calcsize(fmt)
+            unpack_from = struct.unpack_from
+            def read(buf, pos):
+                return unpack_from(fmt, buf, pos)[0], pos + size
+        return read
+
+    def encode_into(self, obj, buf, pos):
+        """
+        Write the encoded form of obj into buf at pos.
+        Returns the position right after it. Raises IndexError if buf is
+        too small.
+        """
+        steps = self._enc
+        if self._record is not None and isinstance(obj, tuple):
+            steps = self._enc_slots
+        for key, put, measure, required, label in steps:
+            try:
+                value = obj[key]
+            except (IndexError, KeyError):
+                raise CodecError('Insufficient parameters '
+                                 '(empty field {0} not padded with None)'.format(label))
+            if value is None:
+                if required:
+                    raise CodecError('Required field cannot be None.')
+                continue
+            pos = put(buf, pos, value)
+        return pos
+
+    def _encode_into_trusted(self, obj, buf, pos):
+        """
+        encode_into() for trusted wires, without the checks on the values
+        in obj. A missing field is still a CodecError, not an IndexError
+        that would pass for a full buffer.
+        """
+        steps = self._enc
+        if self._record is not None and isinstance(obj, tuple):
+            steps = self._enc_slots
+        for key, put, measure, required, label in steps:
+            try:
+                value = obj[key]
+            except (IndexError, KeyError):
+                raise CodecError('Insufficient parameters '
+                                 '(empty field {0} not padded with None)'.format(label))
+            if value is not None:
+                pos = put(buf, pos, value)
+        return pos
+
+    def size(self, obj):
+        """
+        Exact number of bytes encode_into() would write for obj.
+        """
+        total = 0
+        steps = self._enc
+        if self._record is not None and isinstance(obj, tuple):
+            steps = self._enc_slots
+        for key, put, measure, required, label in steps:
+            try:
+                value = obj[key]
+            except (IndexError, KeyError):
+                raise CodecError('Insufficient parameters '
+                                 '(empty field {0} not padded with None)'.format(label))
+            if value is None:
+                if required:
+                    raise CodecError('Required field cannot be None.')
+                continue
+            total += measure(value)
+        return total
+
+    def decode(self, buf, pos, end):
+        """
+        Decode the message stored in buf[pos:end].
+        """
+        result = self._blank.copy() if self._kv else list(self._blank)
+        handlers = self._dec
+        vint_at = self._vint_at
+        # every field takes at least 2 bytes, so only count the fields of
+        # messages long enough to go over the limit
+        max_fields = self._max_fields
+        if max_fields is not None and end - pos <= 2 * max_fields:
+            max_fields = None
+        count = 0
+        while pos < end:
+            tag, pos = vint_at(buf, pos)
+            if max_fields is not None:
+                count += 1
+                if count > max_fields:
+                    raise _too_many_fields(max_fields)
+            handler = handlers.get(tag >> 3)
+            if handler is None:
+                pos = _skip_at(buf, pos, tag & 7, vint_at)
+            else:
+                pos = handler(buf, pos, tag & 7, result)
+        if pos != end:
+            raise CodecError('Unexpected end of message')
+
+        for slot, kind, typecode in self._post:
+            result[slot] = self._finish(slot, kind, result[slot], typecode)
+
+        return result if self._make is None else self._make(result)
+
+    @staticmethod
+    def _finish(key, kind, value, typecode=None):
+        """
+        Check a required field or turn the collected values of a repeated
+        field into a tuple. Packed fields with a typecode are already
+        collected in an array.
+        """
+        if kind == '*':
+            if value is None:
+                raise CodecError('Field {0} is required but is empty'.format(key))
+            return value
+        if typecode is not None:
+            return array(typecode) if value is None else value
+        return () if value is None else tuple(value)
+
+    def scan(self, buf, pos, end):
+        """
+        Walk the message stored in buf[pos:end] once without decoding
+        anything. Returns a dict that maps the id of every known field
+        present to the (position << 3 | wire type) of its value, or to a
+        list of those if the field occurs more than once.
+        """
+        offsets = {}
+        handlers = self._dec
+        vint_at = self._vint_at
+        max_fields = self._max_fields
+        if max_fields is not None and end - pos <= 2 * max_fields:
+            max_fields = None
+        count = 0
+        while pos < end:
+            tag, pos = vint_at(buf, pos)
+            if max_fields is not None:
+                count += 1
+                if count > max_fields:
+                    raise _too_many_fields(max_fields)
+            field_id = tag >> 3
+            wire_type = tag & 7
+            if field_id in handlers:
+                entry = (pos << 3) | wire_type
+                previous = offsets.get(field_id)
+                if previous is None:
+                    offsets[field_id] = entry
+                elif isinstance(previous, list):
+                    previous.append(entry)
+                else:
+                    offsets[field_id] = [previous, entry]
+            pos = _skip_at(buf, pos, wire_type, vint_at)
+        if pos != end:
+            raise CodecError('Unexpected end of message')
+        return offsets
+
+    def decode_field(self, buf, key, found):
+        """
+        Decode a single field from the entries scan() recorded for it.
+        A lone nested message is returned as a MessageView of its own.
+        """
+        field_id, kind, sub, slot = self._fields[key]
+        if found is None:
+            value = None
+        elif kind == '[' and not isinstance(found, list):
+            pos, wire_type = found >> 3, found & 7
+            if wire_type != 2:
+                raise _wire_type_mismatch(2, wire_type)
+            if sub._deep:
+                raise _too_deep(sub._max_depth)
+            length, pos = self._vint_at(buf, pos)
+            return MessageView(sub, buf, pos, pos + length)
+        else:
+            result = {slot: None}
+            handler = self._dec[field_id]
+            for entry in (found if isinstance(found, list) else (found, )):
+                handler(buf, entry >> 3, entry & 7, result)
+            value = result[slot]
+
+        for post_slot, post_kind, typecode in self._post:
+            if post_slot == slot:
+                value = self._finish(key, post_kind, value, typecode)
+        return value
+
+    def merge(self, old, new):
+        """
+        Merge two decoded instances of the same message the way Protobuf
+        merges a non-repeated nested field that appears more than once.
+        """
+        result = dict(old) if self._kv else list(old)
+        for field_id, kind, sub, slot in self._fields.values():
+            value = new[slot]
+            if kind == '+' or kind == '#':
+                result[slot] = old[slot] + value
+            elif value is None:
+                continue
+            elif kind == '[' and old[slot] is not None:
+                result[slot] = sub.merge(old[slot], value)
+            else:
+                result[slot] = value
+        return result if self._make is None else self._make(result)
+
+
+class Decoder(object):
+    '''
+    Resumable decoder for a stream of messages, each prefixed with its
+    length as a vint (the Protobuf length-delimited format).
+    Chunks of any size are passed to feed(), which keeps the parse state
+    between calls and returns the messages completed by each chunk.
+    Every byte is looked at once no matter how the stream is split.
+    Messages that arrive whole inside one chunk are decoded in place,
+    the rest are collected in a buffer of their exact length.
+    A message that fails to decode, or whose length is over max_length,
+    is skipped and the stream stays in step; the errors are left in
+    errors until the next call to feed().
+    Created by Wire.decoder().
+    '''
+    def __init__(self, wire, copy=True, max_length=None):
+        self._wire = wire
+        self._copy = copy
+        if max_length is None:
+            max_length = wire._max_bytes
+        self._max_length = max_length
+        self.errors = ()
+        self.reset()
+
+    def reset(self):
+        """
+        Drop any partially received message.
+        """
+        self._length = 0
+        self._shift = 0
+        self._body = None
+        self._filled = 0
+        # bytes of an oversized message still to be skipped
+        self._skip = 0
+
+    @property
+    def partial(self):
+        """
+        True if part of a message has been fed but it is not complete yet.
+        """
+        return self._shift != 0 or self._body is not None or self._skip != 0
+
+    def _error(self, e):
+        if not self.errors:
+            self.errors = []
+        self.errors.append(e)
+
+    def _decode(self, data, messages):
+        try:
+            message = self._wire.decode(data, copy=self._copy)
+        except _TRUNCATED:
+            self._error(CodecError('Unexpected end of message'))
+            return messages
+        except (CodecError, EOFError, TypeError, ValueError) as e:
+            # ValueError also covers bad UTF-8 in string fields
+            self._error(e)
+            return messages
+        if not messages:
+            messages = []
+        messages.append(message)
+        return messages
+
+    def feed(self, chunk):
+        """
+        Feed the next chunk of the stream.
+        Returns a list of the messages completed by this chunk, or an
+        empty tuple if there are none. Messages that could not be decoded
+        are left out and their exceptions are in errors afterwards.
+        With copy=False, bytes fields of messages decoded in place are
+        memoryview slices of chunk.
+        """
+        buf = memoryview(chunk)
+        end = len(buf)
+        pos = 0
+        messages = ()
+        self.errors = ()
+        while pos < end:
+            if self._skip:
+                take = min(self._skip, end - pos)
+                pos += take
+                self._skip -= take
+                continue
+            body = self._body
+            if body is None:
+                # length prefix, possibly split between chunks
+                byte = buf[pos]
+                pos += 1
+                self._length |= (byte & 0x7f) << self._shift
+                if byte & 0x80:
+                    self._shift += 7
+                    if self._shift > 63:
+                        # nothing to resync on, start over with the next byte
+                        self.reset()
+                        self._error(CodecError('Length prefix is too long'))
+                    continue
+                length = self._length
+                self._length = 0
+                self._shift = 0
+                if self._max_length is not None and length > self._max_length:
+                    self._error(CodecError('Message length {0} is over the limit'.format(length)))
+                    self._skip = length
+                    continue
+                if end - pos >= length:
+                    start = pos
+                    pos += length
+                    messages = self._decode(buf[start:pos], messages)
+                    continue
+                body = self._body = bytearray(length)
+                self._filled = 0
+
+            filled = self._filled
+            take = min(len(body) - filled, end - pos)
+            body[filled:filled + take] = buf[pos:pos + take]
+            pos += take
+            self._filled = filled + take
+            if self._filled == len(body):
+                self._body = None
+                messages = self._decode(body, messages)
+        return messages
+
+
+class MessageView(object):
+    '''
+    Lazily decoded message returned by Wire.decode_lazy().
+    Field offsets are found by a single scan when the view is created and
+    each field is decoded the first time it is looked up, by name in
+    key-value mode or by index otherwise.
+    '''
+    __slots__ = ('_codec', '_buf', '_pos', '_end', '_offsets', '_cache')
+
+    def __init__(self, codec, buf, pos, end):
+        self._codec = codec
+        self._buf = buf
+        self._pos = pos
+        self._end = end
+        self._offsets = codec.scan(buf, pos, end)
+        self._cache = {}
+
+    def __getitem__(self, key):
+        cache = self._cache
+        if key in cache:
+            return cache[key]
+        # unknown keys raise KeyError here, like a dict would
+        field_id = self._codec._fields[key][0]
+        try:
+            # nested messages are only scanned now, their errors show up here
+            value = self._codec.decode_field(self._buf, key, self._offsets.get(field_id))
+        except _TRUNCATED:
+            raise CodecError('Unexpected end of message')
+        cache[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self._codec._fields:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self._codec._fields
+
+    def __len__(self):
+        return len(self._codec._keys)
+
+    def __iter__(self):
+        return iter(self._codec._keys)
+
+    def keys(self):
+        return self._codec._keys
+
+    def items(self):
+        return [(key, self[key]) for key in self._codec._keys]
+
+    def unpack(self):
+        """
+        Decode the whole message the way Wire.decode() would.
+        """
+        try:
+            return self._codec.decode(self._buf, self._pos, self._end)
+        except _TRUNCATED:
+            raise CodecError('Unexpected end of message')
+
+
+def _enc_plain(header, write):
+    # field ids up to 15 have a single byte header
+    if len(header) == 1:
+        header = header[0]
+        def put(buf, pos, value):
+            buf[pos] = header
+            return write(buf, pos + 1, value)
+    else:
+        def put(buf, pos, value):
+            return write(buf, _put_bytes(buf, pos, header), value)
+    return put
+
+
+def _enc_repeated(header, write):
+    if len(header) == 1:
+        header = header[0]
+        def put(buf, pos, values):
+            for value in values:
+                buf[pos] = header
+                pos = write(buf, pos + 1, value)
+            return pos
+    else:
+        def put(buf, pos, values):
+            for value in values:
+                pos = write(buf, _put_bytes(buf, pos, header), value)
+            return pos
+    return put
+
+
+def _enc_packed(header, write):
+    def put(buf, pos, values):
+        start = _put_bytes(buf, pos, header)
+        pos = start + 1
+        for value in values:
+            pos = write(buf, pos, value)
+        return _close_length(buf, start, pos)
+    return put
+
+
+def _enc_packed_fixed(header, field_type):
+    size = struct.calcsize('<' + field_type)
+    pack_into = struct.pack_into
+
+    def put(buf, pos, values):
+        count = len(values)
+        pos = _put_uvint(buf, _put_bytes(buf, pos, header), count * size)
+        end = pos + count * size
+        if end > len(buf):
+            raise IndexError('buffer too small')
+        pack_into('<{0}{1}'.format(count, field_type), buf, pos, *values)
+        return end
+    return put
+
+
+def _size_plain(header_size, size):
+    def measure(value):
+        return header_size + size(value)
+    return measure
+
+
+def _size_repeated(header_size, size):
+    def measure(values):
+        total = 0
+        for value in values:
+            total += header_size + size(value)
+        return total
+    return measure
+
+
+def _size_packed(header_size, size):
+    def measure(values):
+        length = 0
+        for value in values:
+            length += size(value)
+        return header_size + _vint_size(length) + length
+    return measure
+
+
+def _size_packed_fixed(header_size, field_type):
+    size = struct.calcsize('<' + field_type)
+
+    def measure(values):
+        length = len(values) * size
+        return header_size + _vint_size(length) + length
+    return measure
+
+
+def _wire_type_mismatch(expected, actual):
+    return TypeError(
+        'Wire type mismatch (expect {0} but got {1})'.format(expected, actual)
+    )
+
+
+def _too_deep(max_depth):
+    return CodecError('Nesting is deeper than the limit of {0}'.format(max_depth))
+
+
+def _too_many_fields(max_fields):
+    return CodecError('Message has more than the limit of {0} fields'.format(max_fields))
+
+
+def _dec_plain(key, wire_type, read):
+    def handler(buf, pos, actual, result):
+        if actual != wire_type:
+            raise _wire_type_mismatch(wire_type, actual)
+        result[key], pos = read(buf, pos)
+        return pos
+    return handler
+
+
+def _dec_plain_trusted(key, read):
+    def handler(buf, pos, actual, result):
+        result[key], pos = read(buf, pos)
+        return pos
+    return handler
+
+
+def _dec_nested(key, sub):
+    vint_at = sub._vint_at
+
+    def handler(buf, pos, actual, result):
+        if actual != 2:
+            raise _wire_type_mismatch(2, actual)
+        length, pos = vint_at(buf, pos)
+        end = pos + length
+        value = sub.decode(buf, pos, end)
+        previous = result[key]
+        result[key] = value if previous is None else sub.merge(previous, value)
+        return end
+    return handler
+
+
+def _dec_repeated(key, wire_type, read):
+    def handler(buf, pos, actual, result):
+        if actual != wire_type:
+            raise _wire_type_mismatch(wire_type, actual)
+        value, pos = read(buf, pos)
+        values = result[key]
+        if values is None:
+            result[key] = [value]
+        else:
+            values.append(value)
+        return pos
+    return handler
+
+
+def _dec_repeated_trusted(key, read):
+    def handler(buf, pos, actual, result):
+        value, pos = read(buf, pos)
+        values = result[key]
+        if values is None:
+            result[key] = [value]
+        else:
+            values.append(value)
+        return pos
+    return handler
+
+
+def _dec_too_deep(max_depth):
+    def handler(buf, pos, actual, result):
+        raise _too_deep(max_depth)
+    return handler
+
+
+def _dec_packed(key, field_id, read, vint_at=_vint_at):
+    def handler(buf, pos, actual, result):
+        if actual != 2:
+            raise CodecError('Packed repeated field {0} has wire type other than str'.format(field_id))
+        length, pos = vint_at(buf, pos)
+        end = pos + length
+        values = result[key]
+        if values is None:
+            result[key] = values = []
+        while pos < end:
+            value, pos = read(buf, pos)
+            values.append(value)
+        if pos != end:
+            raise CodecError('Unexpected end of message while decoding field {0}'.format(field_id))
+        return pos
+    return handler
+
+
+def _dec_packed_fixed(key, field_id, field_type, vint_at=_vint_at):
+    size = struct.calcsize('<' + field_type)
+    unpack_from = struct.unpack_from
+
+    def handler(buf, pos, actual, result):
+        if actual != 2:
+            raise CodecError('Packed repeated field {0} has wire type other than str'.format(field_id))
+        length, pos = vint_at(buf, pos)
+        count = length // size
+        if count * size != length:
+            raise CodecError('Unexpected end of message while decoding field {0}'.format(field_id))
+        values = array(field_type, unpack_from('<{0}{1}'.format(count, field_type), buf, pos))
+        previous = result[key]
+        if previous is None:
+            result[key] = values
+        else:
+            previous.extend(values)
+        return pos + length
+    return handler
+
+
+def _dec_packed_array(key, field_id, field_type, read, typecode, vint_at=_vint_at):
+    # single byte vints are the same number for T and t
+    inline = field_type != 'z'
+
+    def handler(buf, pos, actual, result):
+        if actual != 2:
+            raise CodecError('Packed repeated field {0} has wire type other than str'.format(field_id))
+        length, pos = vint_at(buf, pos)
+        end = pos + length
+        values = result[key]
+        if values is None:
+            result[key] = values = array(typecode)
+        append = values.append
+        try:
+            while pos < end:
+                b = buf[pos]
+                if b < 0x80 and inline:
+                    append(b)
+                    pos += 1
+                else:
+                    value, pos = read(buf, pos)
+                    append(value)
+        except OverflowError:
+            raise CodecError('Packed value does not fit array type {0}'.format(typecode))
+        if pos != end:
+            raise CodecError('Unexpected end of message while decoding field {0}'.format(field_id))
+        return pos
+    return handler
+
+
 def encode(fmtstr, *stuff):
     """Encode given Python object(s) to binary wire using fmtstr"""
     return Wire(fmtstr).encode(*stuff)
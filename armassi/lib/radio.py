@@ -0,0 +1,191 @@
+"""
+Simulated radios for Communication. On the device it drives the SX127x
+driver (armachat_lora.RFM9x); anything passed as radio= must have the
+part of its surface listed in comms.RADIO_SURFACE, which Communication
+checks: listen() starts receiving, send() transmits a frame, rx_done()
+tells whether a frame has been received and receive() returns it as a
+bytearray the caller may modify. last_snr and last_rssi describe the
+last received frame.
+
+VirtualRadio and VirtualMedium put many radios on a simulated shared
+channel so Communication instances can talk to each other on a desktop.
+They are meant for CPython, not the device.
+"""
+import math
+import random
+import time
+
+from comms import lora_airtime
+
+__all__ = ["VirtualMedium", "VirtualRadio"]
+
+
+class VirtualMedium:
+    """
+    Shared channel between VirtualRadios. Every frame occupies the channel
+    for its time on air. A receiver gets a frame if its modem settings
+    match, the link is not lost and the SNR is above the sensitivity for
+    the spreading factor. Frames overlapping at a receiver collide, unless
+    one is capture_db stronger, and a radio cannot hear while it sends.
+
+    Links default to a log-distance path loss between radio positions in
+    metres; set_link() overrides them per pair. clock returns seconds.
+    """
+
+    def __init__(self, clock=time.monotonic, seed=None, path_loss_exponent=2.7,
+                 reference_loss=32.0, noise_figure=6.0, capture_db=6.0):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.path_loss_exponent = path_loss_exponent
+        self.reference_loss = reference_loss
+        self.noise_figure = noise_figure
+        self.capture_db = capture_db
+        self.radios = []
+        self.links = {}
+        self.transmissions = 0
+        self.delivered = 0
+        # Frames that did not reach a receiver, by cause
+        self.lost = 0
+        self.collisions = 0
+        self.airtime = 0.0
+
+    def attach(self, radio):
+        self.radios.append(radio)
+
+    def set_link(self, a, b, loss=None, rssi=None, snr=None, symmetric=True):
+        """
+        Override the link from a to b. loss is the probability a frame is
+        lost, rssi and snr what b measures; None keeps the computed value.
+        """
+        self.links[(a, b)] = (loss, rssi, snr)
+        if symmetric:
+            self.links[(b, a)] = (loss, rssi, snr)
+
+    def link(self, a, b):
+        """(loss, rssi, snr) of frames from a as received by b."""
+        distance = max(math.hypot(a.x - b.x, a.y - b.y), 1.0)
+        rssi = a.tx_power - self.reference_loss - 10 * self.path_loss_exponent * math.log10(distance)
+        noise = -174 + 10 * math.log10(b.bw) + self.noise_figure
+        loss, snr = 0.0, rssi - noise
+        override = self.links.get((a, b))
+        if override:
+            loss = loss if override[0] is None else override[0]
+            rssi = rssi if override[1] is None else override[1]
+            snr = snr if override[2] is None else override[2]
+        return loss, rssi, snr
+
+    def transmit(self, sender, frame, start, end):
+        self.transmissions += 1
+        self.airtime += end - start
+        # Whatever the sender was receiving is lost when it starts sending
+        for reception in sender.receptions:
+            if reception[2] > start:
+                reception[5] = False
+        for radio in self.radios:
+            if radio is sender:
+                continue
+            if (radio.sf, radio.bw, radio.hz) != (sender.sf, sender.bw, sender.hz):
+                continue
+            loss, rssi, snr = self.link(sender, radio)
+            # Demodulator floor, SF7 needs -7.5 dB and every step 2.5 dB less
+            if snr < -7.5 - 2.5 * (radio.sf - 7):
+                continue
+            ok = self.random.random() >= loss
+            if not ok:
+                self.lost += 1
+            if radio.tx_until > start and radio.tx_start < end:
+                ok = False
+            reception = [frame, start, end, rssi, snr, ok]
+            for other in radio.receptions:
+                if other[1] < end and start < other[2]:
+                    if rssi - other[3] < self.capture_db:
+                        # Not strong enough to capture the receiver
+                        self.collide(reception)
+                    if other[3] - rssi < self.capture_db:
+                        self.collide(other)
+            radio.receptions.append(reception)
+
+    def collide(self, reception):
+        if reception[5]:
+            reception[5] = False
+            self.collisions += 1
+
+
+class VirtualRadio:
+    """
+    A radio on a VirtualMedium at position (x, y). The modem settings
+    decide the time on air of every frame, send() returns at once and
+    the channel stays busy until the frame is over.
+    """
+
+    def __init__(self, medium, x=0.0, y=0.0, sf=7, bw=125000, cr=5, preamble=8,
+                 ldro=False, tx_power=14, hz=868.0, max_pending=32):
+        self.medium = medium
+        self.x = x
+        self.y = y
+        self.sf = sf
+        self.bw = bw
+        self.cr = cr
+        self.preamble = preamble
+        self.ldro = ldro
+        self.tx_power = tx_power
+        self.hz = hz
+        self.max_pending = max_pending
+        # [frame, start, end, rssi, snr, ok] per frame reaching this radio
+        self.receptions = []
+        self.tx_start = 0.0
+        self.tx_until = 0.0
+        self.last_snr = 0.0
+        self.last_rssi = 0
+        self.sent = 0
+        self.received = 0
+        medium.attach(self)
+
+    @classmethod
+    def from_config(cls, medium, lora_config, x=0.0, y=0.0):
+        """Radio with the modem settings of a Communication lora_config."""
+        return cls(medium, x=x, y=y, sf=lora_config.get("sf", 7), bw=lora_config.get("bw", 125000),
+                   cr=lora_config.get("cr", 5), preamble=lora_config.get("pl", 8),
+                   ldro=bool(lora_config.get("ld", 0)), tx_power=lora_config.get("tx", 14),
+                   hz=lora_config.get("hz", 868.0))
+
+    def listen(self):
+        # Always listening unless sending
+        pass
+
+    def send(self, data):
+        start = max(self.medium.clock(), self.tx_until)
+        airtime = lora_airtime(len(data), sf=self.sf, bw=self.bw, cr=self.cr,
+                               preamble=self.preamble, ldro=self.ldro) / 1000
+        self.tx_start = start
+        self.tx_until = start + airtime
+        self.sent += 1
+        self.medium.transmit(self, bytes(data), start, self.tx_until)
+        return True
+
+    def _prune(self, now):
+        # Drop frames that were lost on the way and cap what is left
+        receptions = self.receptions
+        if receptions:
+            receptions[:] = [r for r in receptions if r[5] or r[2] > now]
+            del receptions[:-self.max_pending]
+
+    def rx_done(self):
+        now = self.medium.clock()
+        self._prune(now)
+        for reception in self.receptions:
+            if reception[5] and reception[2] <= now:
+                return True
+        return False
+
+    def receive(self):
+        now = self.medium.clock()
+        for index, reception in enumerate(self.receptions):
+            if reception[5] and reception[2] <= now:
+                del self.receptions[index]
+                self.last_rssi = int(reception[3])
+                self.last_snr = round(reception[4] * 4) / 4
+                self.received += 1
+                self.medium.delivered += 1
+                return bytearray(reception[0])
+        return None
@@ -0,0 +1,150 @@
+"""
+Pure Python stand-in for CircuitPython's aesio, so channel encryption
+works when comms.py runs on a desktop. Only what comms.py needs is
+there: AES-128/256 in CTR mode with encrypt_into, decrypt_into and
+rekey. It is table driven but still far slower than aesio, use it for
+tests and simulations only.
+"""
+import struct
+
+__all__ = ["AES", "MODE_CTR"]
+
+# Same value as aesio
+MODE_CTR = 6
+
+
+def _tables():
+    sbox = bytearray(256)
+    # Walk the multiplicative group with generator 3 and its inverse
+    p = q = 1
+    while True:
+        p = p ^ ((p << 1) & 0xff) ^ (0x1b if p & 0x80 else 0)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        x = q ^ (q << 1 | q >> 7) ^ (q << 2 | q >> 6) ^ (q << 3 | q >> 5) ^ (q << 4 | q >> 4)
+        sbox[p] = (x ^ 0x63) & 0xff
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    t0 = [0] * 256
+    for i in range(256):
+        s = sbox[i]
+        s2 = ((s << 1) ^ (0x1b if s & 0x80 else 0)) & 0xff
+        t0[i] = (s2 << 24) | (s << 16) | (s << 8) | (s2 ^ s)
+    t1 = [(t >> 8) | ((t & 0xff) << 24) for t in t0]
+    t2 = [(t >> 8) | ((t & 0xff) << 24) for t in t1]
+    t3 = [(t >> 8) | ((t & 0xff) << 24) for t in t2]
+    return sbox, t0, t1, t2, t3
+
+
+_SBOX, _T0, _T1, _T2, _T3 = _tables()
+
+
+def _expand_key(key):
+    words = len(key) // 4
+    rounds = words + 6
+    rk = list(struct.unpack(">%dI" % words, key))
+    rcon = 1
+    sbox = _SBOX
+    for i in range(words, 4 * (rounds + 1)):
+        t = rk[i - 1]
+        if i % words == 0:
+            t = ((sbox[(t >> 16) & 0xff] << 24) | (sbox[(t >> 8) & 0xff] << 16)
+                 | (sbox[t & 0xff] << 8) | sbox[t >> 24]) ^ (rcon << 24)
+            rcon = ((rcon << 1) ^ (0x1b if rcon & 0x80 else 0)) & 0xff
+        elif words > 6 and i % words == 4:
+            t = ((sbox[t >> 24] << 24) | (sbox[(t >> 16) & 0xff] << 16)
+                 | (sbox[(t >> 8) & 0xff] << 8) | sbox[t & 0xff])
+        rk.append(rk[i - words] ^ t)
+    return rk, rounds
+
+
+class AES:
+    """
+    AES context like aesio.AES, in CTR mode only. The key schedule is computed when the
+    object is made and only again when rekey() is given a different key,
+    so rekeying with a new IV per packet is cheap.
+    """
+
+    def __init__(self, key, mode=MODE_CTR, IV=None, segment_size=8):
+        if mode != MODE_CTR:
+            raise ValueError("Only MODE_CTR is supported")
+        self.mode = mode
+        self._key = None
+        self._stream = bytearray(16)
+        self.rekey(key, IV)
+
+    def rekey(self, key, IV=None):
+        if len(key) not in (16, 24, 32):
+            raise ValueError("Key must be 16, 24, or 32 bytes long")
+        key = bytes(key)
+        if key != self._key:
+            self._rk, self._rounds = _expand_key(key)
+            self._key = key
+        iv = bytes(IV) if IV is not None else bytes(16)
+        if len(iv) != 16:
+            raise ValueError("IV must be 16 bytes long")
+        self._counter = int.from_bytes(iv, "big")
+        # Keystream bytes left over from the last block
+        self._used = 16
+
+    def _next_block(self):
+        """Encrypt the counter, advance it and return the keystream block."""
+        rk = self._rk
+        t0, t1, t2, t3 = _T0, _T1, _T2, _T3
+        counter = self._counter
+        s0 = (counter >> 96) ^ rk[0]
+        s1 = ((counter >> 64) & 0xffffffff) ^ rk[1]
+        s2 = ((counter >> 32) & 0xffffffff) ^ rk[2]
+        s3 = (counter & 0xffffffff) ^ rk[3]
+        self._counter = (counter + 1) & ((1 << 128) - 1)
+        k = 4
+        for _ in range(self._rounds - 1):
+            s0, s1, s2, s3 = (
+                t0[s0 >> 24] ^ t1[(s1 >> 16) & 0xff] ^ t2[(s2 >> 8) & 0xff] ^ t3[s3 & 0xff] ^ rk[k],
+                t0[s1 >> 24] ^ t1[(s2 >> 16) & 0xff] ^ t2[(s3 >> 8) & 0xff] ^ t3[s0 & 0xff] ^ rk[k + 1],
+                t0[s2 >> 24] ^ t1[(s3 >> 16) & 0xff] ^ t2[(s0 >> 8) & 0xff] ^ t3[s1 & 0xff] ^ rk[k + 2],
+                t0[s3 >> 24] ^ t1[(s0 >> 16) & 0xff] ^ t2[(s1 >> 8) & 0xff] ^ t3[s2 & 0xff] ^ rk[k + 3])
+            k += 4
+        sbox = _SBOX
+        block = 0
+        for a, b, c, d in ((s0, s1, s2, s3), (s1, s2, s3, s0), (s2, s3, s0, s1), (s3, s0, s1, s2)):
+            block = (block << 32) | (((sbox[a >> 24] << 24) | (sbox[(b >> 16) & 0xff] << 16)
+                                      | (sbox[(c >> 8) & 0xff] << 8) | sbox[d & 0xff]) ^ rk[k])
+            k += 1
+        return block
+
+    def encrypt_into(self, src, dest):
+        """XOR src with the keystream into dest, which may be src itself."""
+        if len(src) != len(dest):
+            raise ValueError("Source and dest buffers must be the same length")
+        stream = self._stream
+        used = self._used
+        length = len(src)
+        i = 0
+        while used < 16 and i < length:
+            dest[i] = src[i] ^ stream[used]
+            used += 1
+            i += 1
+        # Whole blocks are XORed with the keystream as one big number
+        end = i + (length - i) // 16 * 16
+        if end > i:
+            stream_blocks = 0
+            for _ in range((end - i) // 16):
+                stream_blocks = (stream_blocks << 128) | self._next_block()
+            dest[i:end] = (int.from_bytes(src[i:end], "big") ^ stream_blocks).to_bytes(end - i, "big")
+            i = end
+        if i < length:
+            stream[0:16] = self._next_block().to_bytes(16, "big")
+            used = 0
+            while i < length:
+                dest[i] = src[i] ^ stream[used]
+                used += 1
+                i += 1
+        self._used = used
+
+    decrypt_into = encrypt_into
@@ -6,6 +6,7 @@ from screen import Screen
 from textwrap import wrap
 from picotui import widgets, menu, defs
 from keys import get_keymaps
+from comms import KIND_TEXT, KIND_DELIVERY
 
 try:
     pass
@@ -147,6 +148,9 @@ class Terminal:
                             self.menubar.handle_input(defs.KEY_RIGHT)
                     else:
                         self.root_container.handle_input(input.encode("utf-8"))
+                        # Refuse keystrokes that would not fit into a single LoRa frame
+                        if not self.comms.text_fits(self.inputbox.get()):
+                            self.root_container.handle_input(defs.KEY_BACKSPACE)
             return state_updated
         return state_updated
 
@@ -154,14 +158,20 @@ class Terminal:
         self.comms.loop()
         received_messages = self.comms.get_messages()
         if len(received_messages) > 0:
-            for message in received_messages:
-                if not isinstance(message, str):
-                    message_text = message.packet['payload'].decode("utf-8")
-                    self.add_line(message_text, nick_id=message.src, timestamp=message.tstamp)
+            # Slots are reused by the ring, keep copies of what they hold
+            message = received_messages.pop()
+            while message is not None:
+                if message.kind == KIND_DELIVERY:
+                    self.mark_delivery(message.id, message.delivered)
+                elif message.kind == KIND_TEXT:
+                    nick_id = bytes(message.src)
+                    # Only our own lines wait for an ack, received ids may be anything
+                    msg_id = message.id if nick_id == self.comms.my_address else None
+                    self.add_line(message.text(), nick_id=nick_id, timestamp=message.tstamp, msg_id=msg_id)
                 else:
-                    self.add_line(message, timestamp=time.localtime())
+                    self.add_line(message.text(), timestamp=message.tstamp)
+                message = received_messages.pop()
 
-            self.comms.clear_messages()
             self.render_lines()
             return True
         return False
@@ -188,8 +198,16 @@ class Terminal:
         if self.statusbar.t != previous_statusbar:
             self.statusbar.redraw()
 
-    def add_line(self, line, nick_id=None, timestamp=False):
-        self.lines.append((time.localtime() if timestamp else None, nick_id, line))
+    def add_line(self, line, nick_id=None, timestamp=False, msg_id=None):
+        self.lines.append((time.localtime() if timestamp else None, nick_id, line, msg_id))
+
+    def mark_delivery(self, msg_id, delivered):
+        # Acks arrive within a minute or so, only look at recent lines
+        for idx in range(len(self.lines) - 1, max(len(self.lines) - 50, 0) - 1, -1):
+            stamp, nick_id, line, line_id = self.lines[idx]
+            if line_id == msg_id and nick_id == self.comms.my_address:
+                self.lines[idx] = (stamp, nick_id, line + (" [ack]" if delivered else " [failed]"), None)
+                return
 
     def render_lines(self):
         lines = []
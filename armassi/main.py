@@ -48,13 +48,17 @@ class Armassi:
             self.write_config()
         else:
             self.my_address = binascii.unhexlify(self.json_config["lora_mac"])
-        encryption_key = None
+        # Channel PSK in base64 like the Meshtastic apps show it, "AQ==" is
+        # the default key of the public channel and "" turns encryption off
+        encryption_key = binascii.a2b_base64(self.json_config.get("psk", "AQ=="))
         
         self.nicknames = {}
         nick = (self.get_nick, self.set_nick, self.get_nick_for_id, self.add_nick_for_id)
         gc.collect()
         self.comms = Communication(lora_config, my_address=self.my_address, remote_address=remote_address,
-                                   encryption_key=encryption_key, encryption_iv=encryption_iv, nick=nick, beep=beep, led=led)
+                                   encryption_key=encryption_key, encryption_iv=encryption_iv, nick=nick, beep=beep, led=led,
+                                   relay=self.json_config.get("relay", False),
+                                   channel=self.json_config.get("channel", "LongFast"))
         
         gc.collect()
         self.terminal = Terminal(display=display, width=display.width if display else 320,
@@ -0,0 +1,54 @@
+"""
+Channel encryption cost per packet.
+
+Run on the host from the repository root:
+
+    python3 bench/crypto_bench.py
+
+On the host comms.py falls back to the pure Python softaes module, so
+the absolute numbers are far above what aesio does on the device; the
+difference between the two paths is the per packet setup and copying.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "armassi", "lib"))
+
+from minipb_bench import measure, report  # noqa: E402
+from comms import ChannelCipher, aesio  # noqa: E402
+
+ROUNDS = 2000
+
+PSK = b"\x01"
+
+
+def per_packet_context(key):
+    """What send() and receive() did before: a new AES context and output buffer per packet."""
+    def crypt(frame):
+        body = memoryview(frame)[16:]
+        cipher = aesio.AES(key, aesio.MODE_CTR, bytes(frame[8:12]) + bytes(4) + bytes(frame[4:8]) + bytes(4))
+        out = bytearray(len(body))
+        cipher.encrypt_into(body, out)
+        body[:] = out
+    return crypt
+
+
+def bench_crypt():
+    print("Channel encryption per packet, %s backend" % aesio.__name__)
+    channel = ChannelCipher(PSK)
+    old = per_packet_context(channel.key)
+    new = lambda frame: channel.crypt(frame, len(frame))  # noqa: E731
+    for size in (16, 64, 128, 239):
+        frame = bytearray(os.urandom(16 + size))
+        check = bytearray(frame)
+        old(check)
+        new(frame)
+        assert frame == check
+        before = measure(old, frame, ROUNDS)
+        after = measure(new, frame, ROUNDS)
+        report("%d byte payload" % size, before, after)
+        print("  %-28s %8.0f kB/s -> %6.0f kB/s" % ("", size / before * 1e6 / 1024, size / after * 1e6 / 1024))
+
+
+if __name__ == "__main__":
+    bench_crypt()
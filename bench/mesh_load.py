@@ -0,0 +1,117 @@
+"""
+Load test: many Communication nodes exchanging Meshtastic frames over a
+simulated LoRa channel.
+
+Run on the host from the repository root:
+
+    python3 bench/mesh_load.py --nodes 24 --seconds 20
+
+Nodes sit on a square grid and relay each other's broadcasts. Every node
+sends a text now and then; the report counts how many of the other nodes
+got each text, the acks, and what happened on the channel.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "armassi", "lib"))
+
+from comms import KIND_DELIVERY, KIND_TEXT, Communication  # noqa: E402
+from radio import VirtualMedium, VirtualRadio  # noqa: E402
+
+
+class Led:
+    value = False
+
+
+def make_node(index, medium, lora_config, position, relay):
+    address = (0x10000 + index).to_bytes(4, "little")
+    name = "node%d" % index
+    nicks = {}
+
+    def add_nick_for_id(id, nick):
+        if nicks.get(bytes(id)) == nick:
+            return False
+        nicks[bytes(id)] = nick
+        return True
+
+    nick = (lambda: name, None, lambda id: nicks.get(bytes(id), id), add_nick_for_id)
+    radio = VirtualRadio.from_config(medium, lora_config, x=position[0], y=position[1])
+    return Communication(lora_config, my_address=address, encryption_key=b"\x01", nick=nick,
+                         beep=lambda: None, led=Led(), relay=relay, radio=radio)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--nodes", type=int, default=24)
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--spacing", type=float, default=1500.0, help="grid spacing in metres")
+    parser.add_argument("--interval", type=float, default=10.0,
+                        help="mean seconds between texts of one node")
+    parser.add_argument("--sf", type=int, default=7)
+    parser.add_argument("--bw", type=int, default=250000)
+    parser.add_argument("--no-relay", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    medium = VirtualMedium(seed=args.seed)
+    lora_config = {"m": "virtual", "sf": args.sf, "bw": args.bw, "cr": 5, "pl": 16, "tx": 14}
+    side = int(math.ceil(math.sqrt(args.nodes)))
+    nodes = [make_node(i, medium, lora_config, ((i % side) * args.spacing, (i // side) * args.spacing),
+                       not args.no_relay)
+             for i in range(args.nodes)]
+    for node in nodes:
+        node.initialize()
+
+    texts = {}
+    received = 0
+    delivered = failed = 0
+    loops = 0
+    start = time.monotonic()
+    next_text = [start + random.expovariate(1 / args.interval) for _ in nodes]
+    while time.monotonic() - start < args.seconds:
+        now = time.monotonic()
+        for index, node in enumerate(nodes):
+            if now >= next_text[index]:
+                next_text[index] = now + random.expovariate(1 / args.interval)
+                text = "text %d from node%d" % (len(texts), index)
+                if node.send_message(text=text):
+                    texts[text] = 0
+            node.loop()
+            message = node.messages.pop()
+            while message is not None:
+                if message.kind == KIND_TEXT and bytes(message.src) != node.my_address:
+                    texts[message.text()] = texts.get(message.text(), 0) + 1
+                    received += 1
+                elif message.kind == KIND_DELIVERY:
+                    if message.delivered:
+                        delivered += 1
+                    else:
+                        failed += 1
+                message = node.messages.pop()
+        loops += 1
+        time.sleep(0.001)
+    elapsed = time.monotonic() - start
+
+    reach = [count / (len(nodes) - 1) for count in texts.values()]
+    print("%d nodes, %.0f s, %d loops per node" % (len(nodes), elapsed, loops))
+    print("  texts sent                 %6d" % len(texts))
+    print("  texts received             %6d  (%.0f%% of nodes reached on average)"
+          % (received, 100 * sum(reach) / max(len(reach), 1)))
+    print("  acks delivered / failed    %6d / %d" % (delivered, failed))
+    print("  frames on air              %6d  (%.1f s airtime, %.1f%% channel use)"
+          % (medium.transmissions, medium.airtime, 100 * medium.airtime / elapsed))
+    print("  frames received            %6d" % medium.delivered)
+    print("  collisions / link losses   %6d / %d" % (medium.collisions, medium.lost))
+    print("  duplicates / relays cancelled %3d / %d"
+          % (sum(n.history.duplicates for n in nodes), sum(n.tx_queue.cancelled for n in nodes)))
+    print("  TX queue deferred / dropped %5d / %d"
+          % (sum(n.tx_queue.deferred for n in nodes), sum(n.tx_queue.dropped for n in nodes)))
+
+
+if __name__ == "__main__":
+    main()
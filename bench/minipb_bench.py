@@ -0,0 +1,402 @@
+"""
+minipb benchmarks on Meshtastic packets.
+
+Run on the host from the repository root:
+
+    python3 bench/minipb_bench.py
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "armassi", "lib"))
+
+import minipb  # noqa: E402
+from comms import (  # noqa: E402
+    MESHTASTIC_DATA_FORMAT, MESHTASTIC_LIMITS, MESHTASTIC_NODEINFO_FORMAT, MeshtasticData, MeshtasticNodeInfo)
+
+ROUNDS = 20000
+
+NODEINFO = {
+    "num": 0x9a3c51f2,
+    "user": {
+        "id": "user417",
+        "long_name": "user417",
+        "short_name": "US",
+        "macaddr": b"\xf2\x51\x3c\x9a",
+        "hw_model": None,
+        "is_licensed": False,
+    },
+    "position": None,
+    "snr": 6.25,
+    "last_heard": None,
+    "device_metrics": None,
+}
+
+TEXT = {
+    "portnum": 1,
+    "payload": "meet at the north gate at 18:00, bring the spare antenna".encode("utf-8"),
+    "want_response": None,
+    "dest": None,
+    "source": None,
+    "request_id": None,
+    "reply_id": None,
+    "emoji": None,
+}
+
+NODEINFO_DATA = {
+    "portnum": 4,
+    "payload": MeshtasticNodeInfo.encode(NODEINFO),
+    "want_response": None,
+    "dest": None,
+    "source": None,
+    "request_id": None,
+    "reply_id": None,
+    "emoji": None,
+}
+
+
+def measure(fn, arg, rounds=ROUNDS, repeat=3):
+    """Returns the average cost of fn(arg) in microseconds, best of repeat runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / rounds
+
+
+def report(name, before, after):
+    print("  %-28s %8.2f us -> %8.2f us  (%.1fx)" % (name, before, after, before / after))
+
+
+def interpreted_encode(wire):
+    return lambda obj: wire._encode_wire(obj).getvalue()
+
+
+def interpreted_decode(wire):
+    return lambda data: dict(wire._decode_wire(io.BytesIO(data)))
+
+
+def loop_encode_vint(number):
+    """Bit-by-bit vint encoder minipb used before the fast paths."""
+    result = bytearray()
+    while 1:
+        tmp = number & 0x7f
+        number >>= 7
+        if number == 0:
+            result.append(tmp)
+            break
+        result.append(0x80 | tmp)
+    return bytes(result)
+
+
+def loop_decode_vint(buf):
+    """Byte-at-a-time vint decoder minipb used before the fast paths."""
+    ctr = 0
+    result = 0
+    tmp = bytearray(1)
+    while 1:
+        if buf.readinto(tmp) == 0:
+            raise EOFError
+        result |= (tmp[0] & 0x7f) << (7 * ctr)
+        if not (tmp[0] >> 7):
+            break
+        ctr += 1
+    return result
+
+
+def loop_vint_at(buf, pos):
+    """Cursor vint decoder without the fast paths."""
+    result = 0
+    shift = 0
+    while 1:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def loop_put_vint(buf, pos, number):
+    """Cursor vint encoder without the fast paths."""
+    assert number >= 0, 'number is less than 0'
+    while number > 0x7f:
+        buf[pos] = (number & 0x7f) | 0x80
+        number >>= 7
+        pos += 1
+    buf[pos] = number
+    return pos + 1
+
+
+def bench_fields():
+    print("Per-field cost, loops vs. fast paths and precomputed headers")
+    wire = minipb.Wire
+    scratch = bytearray(10)
+    # a header, a portnum and a payload length
+    for name, number in (("1-byte vint", 0x12), ("2-byte vint", 300), ("5-byte vint", 0x9a3c51f2)):
+        data = wire._encode_vint(number)
+        view = memoryview(data)
+        report(name + " encode", measure(loop_encode_vint, number), measure(wire._encode_vint, number))
+        report(name + " decode", measure(lambda d: loop_decode_vint(io.BytesIO(d)), data),
+               measure(lambda d: wire._decode_vint(io.BytesIO(d)), data))
+        report(name + " put (compiled)", measure(lambda n: loop_put_vint(scratch, 0, n), number),
+               measure(lambda n: minipb._put_vint(scratch, 0, n), number))
+        report(name + " read (compiled)", measure(lambda v: loop_vint_at(v, 0), view),
+               measure(lambda v: minipb._vint_at(v, 0), view))
+    fmt = MeshtasticData._fmt[0]
+    report("field header", measure(lambda f: MeshtasticData._encode_header(0, f['field_id']), fmt),
+           measure(lambda f: f['headers'][0], fmt))
+
+
+def bench_compiled():
+    print("Interpreted vs. compiled codecs")
+    cases = (
+        ("text", MeshtasticData, TEXT),
+        ("nodeinfo", MeshtasticData, NODEINFO_DATA),
+        ("nodeinfo payload", MeshtasticNodeInfo, NODEINFO),
+    )
+    for name, wire, obj in cases:
+        data = wire.encode(obj)
+        # compiled wires decode into records, so compare by re-encoding
+        assert wire.encode(interpreted_decode(wire)(data)) == wire.encode(wire.decode(data)) == data
+        assert interpreted_encode(wire)(obj) == data
+        report(name + " encode", measure(interpreted_encode(wire), obj), measure(wire.encode, obj))
+        report(name + " decode", measure(interpreted_decode(wire), data), measure(wire.decode, data))
+
+
+def per_message_read_log(wire, path):
+    """Reads the length prefix a byte at a time, then the message."""
+    result = []
+    with open(path, "rb", buffering=0) as f:
+        while 1:
+            try:
+                length = loop_decode_vint(f)
+            except EOFError:
+                return result
+            result.append(wire.decode(f.read(length)))
+
+
+def per_message_write_log(wire, path, objs):
+    with open(path, "wb", buffering=0) as f:
+        for obj in objs:
+            data = wire.encode(obj)
+            f.write(wire._encode_vint(len(data)))
+            f.write(data)
+
+
+def delimited_read_log(wire, path):
+    with open(path, "rb", buffering=0) as f:
+        return list(wire.iter_delimited(f))
+
+
+def delimited_write_log(wire, path, objs):
+    with open(path, "wb", buffering=0) as f:
+        wire.write_delimited(f, objs)
+
+
+def bench_streams():
+    # unbuffered files, since on the device every read and write goes
+    # to the flash filesystem
+    print("Packet log of 100 messages, per-message I/O vs. delimited streams")
+    log = [TEXT, NODEINFO_DATA] * 50
+    path = os.path.join(tempfile.mkdtemp(), "packets.log")
+    per_message_write_log(MeshtasticData, path, log)
+    with open(path, "rb") as f:
+        data = f.read()
+    assert per_message_read_log(MeshtasticData, path) == delimited_read_log(MeshtasticData, path)
+    report("write log", measure(lambda objs: per_message_write_log(MeshtasticData, path, objs), log, 200),
+           measure(lambda objs: delimited_write_log(MeshtasticData, path, objs), log, 200))
+    with open(path, "rb") as f:
+        assert f.read() == data
+    report("read log", measure(lambda p: per_message_read_log(MeshtasticData, p), path, 200),
+           measure(lambda p: delimited_read_log(MeshtasticData, p), path, 200))
+    os.remove(path)
+
+
+def decode_each(wire, buffers):
+    results = []
+    for data in buffers:
+        try:
+            results.append(wire.decode(data))
+        except (minipb.CodecError, TypeError, ValueError):
+            results.append(None)
+    return results
+
+
+def bench_batch():
+    # decode_many() only collects the errors, it should stay level with the loop
+    print("Batch of 100 packets with a few truncated ones")
+    data = MeshtasticData.encode(TEXT)
+    batch = [data] * 95 + [data[:-3]] * 5
+    assert decode_each(MeshtasticData, batch) == MeshtasticData.decode_many(batch)[0]
+    report("decode loop -> decode_many", measure(lambda b: decode_each(MeshtasticData, b), batch, 500),
+           measure(MeshtasticData.decode_many, batch, 500))
+
+
+def fuzz_cases(rng):
+    """Random packets plus hand-made worst cases for the decoder."""
+    yield "random 239 byte packets", [bytes(rng.getrandbits(8) for _ in range(239)) for _ in range(200)]
+    yield "random mutations", [mutate(rng, MeshtasticData.encode(NODEINFO_DATA)) for _ in range(200)]
+    # a field 15 vint of 4000 continuation bytes builds a huge int
+    yield "long vint", [b"\x78" + b"\xff" * 4000 + b"\x01"]
+    # 50000 unknown fields of two bytes each
+    yield "many fields", [b"\x78\x00" * 50000]
+    yield "oversized packet", [MeshtasticData.encode(dict(TEXT, payload=bytes(60000)))]
+
+
+def mutate(rng, data):
+    data = bytearray(data)
+    for _ in range(rng.randrange(1, 8)):
+        data[rng.randrange(len(data))] = rng.getrandbits(8)
+    return bytes(data)
+
+
+def worst_decode(wire, inputs):
+    """Slowest single decode among inputs in microseconds, errors included."""
+    worst = 0
+    for data in inputs:
+        start = time.perf_counter()
+        try:
+            wire.decode(data)
+        except (minipb.CodecError, TypeError, ValueError):
+            pass
+        worst = max(worst, time.perf_counter() - start)
+    return worst * 1e6
+
+
+def bench_limits():
+    print("Fuzzed and hostile packets, worst decode time without vs. with limits")
+    rng = random.Random(1)
+    for name, inputs in fuzz_cases(rng):
+        MeshtasticData.set_limits()
+        before = min(worst_decode(MeshtasticData, inputs) for _ in range(3))
+        MeshtasticData.set_limits(**MESHTASTIC_LIMITS)
+        report(name, before, min(worst_decode(MeshtasticData, inputs) for _ in range(3)))
+
+
+def per_value_codec(fmt):
+    """Compiled Wire that decodes packed fields value by value into tuples."""
+    array_typecode = minipb._array_typecode
+    minipb._array_typecode = lambda wire, field_type: None
+    try:
+        return minipb.Wire(fmt).compile()
+    finally:
+        minipb._array_typecode = array_typecode
+
+
+def bench_packed():
+    print("Packed repeated fields of 64 values, per value vs. bulk")
+    for name, fmt, values in (
+        ("fixed32", "#I", [0x9a3c51f2 + i for i in range(64)]),
+        ("float", "#f", [i / 4 for i in range(64)]),
+        ("varint", "#T", [i * 3 for i in range(64)]),
+    ):
+        before = per_value_codec(fmt)
+        after = minipb.Wire(fmt).compile()
+        data = after.encode(values)
+        assert before.encode(values) == data
+        assert tuple(after.decode(data)[0]) == before.decode(data)[0]
+        report(name + " encode", measure(before.encode, values), measure(after.encode, values))
+        report(name + " decode", measure(before.decode, data), measure(after.decode, data))
+
+
+def bench_trusted():
+    # the interpreted codecs run the asserts and format checks per field,
+    # the compiled ones only a few checks that trusted mode drops
+    print("Own messages, interpreted and compiled vs. trusted codecs")
+    cases = (
+        ("text", MESHTASTIC_DATA_FORMAT, TEXT),
+        ("nodeinfo", MESHTASTIC_DATA_FORMAT, NODEINFO_DATA),
+        ("nodeinfo body", MESHTASTIC_NODEINFO_FORMAT, NODEINFO),
+    )
+    for name, fmt, obj in cases:
+        interpreted = minipb.Wire(fmt)
+        checked = minipb.Wire(fmt).compile()
+        trusted = minipb.Wire(fmt, trusted=True)
+        data = checked.encode(obj)
+        assert trusted.encode(obj) == interpreted.encode(obj) == data
+        assert trusted.decode(data) == interpreted.decode(data) == checked.decode(data)
+        encode = measure(trusted.encode, obj)
+        decode = measure(trusted.decode, data)
+        report(name + " encode/interp.", measure(interpreted.encode, obj), encode)
+        report(name + " encode/comp.", measure(checked.encode, obj), encode)
+        report(name + " decode/interp.", measure(interpreted.decode, data), decode)
+        report(name + " decode/comp.", measure(checked.decode, data), decode)
+
+
+# The parts of mesh.proto comms.py uses
+MESH_PROTO = """
+syntax = "proto3";
+package meshtastic;
+message Data {
+  int32 portnum = 1; bytes payload = 2; bool want_response = 3; fixed32 dest = 4;
+  fixed32 source = 5; fixed32 request_id = 6; fixed32 reply_id = 7; fixed32 emoji = 8;
+}
+message User {
+  string id = 1; string long_name = 2; string short_name = 3; bytes macaddr = 4; bool is_licensed = 6;
+}
+message NodeInfo { uint32 num = 1; User user = 2; float snr = 4; fixed32 last_heard = 5; }
+"""
+
+
+def schema_setup():
+    """What comms.py does at import time to get its codecs."""
+    data = minipb.Wire([
+        ("portnum", "t"), ("payload", "a"), ("want_response", "b"), ("dest", "I"),
+        ("source", "I"), ("request_id", "I"), ("reply_id", "I"), ("emoji", "I"),
+    ]).compile("MeshtasticData")
+    node_info = minipb.Wire([
+        ("num", "T"),
+        ("user", [("id", "U"), ("long_name", "U"), ("short_name", "U"), ("macaddr", "a"),
+                  ("hw_model", "x"), ("is_licensed", "b")]),
+        ("position", "x"), ("snr", "f"), ("last_heard", "I"), ("device_metrics", "x"),
+    ]).compile("MeshtasticNodeInfo")
+    return data, node_info
+
+
+def bench_codegen():
+    print("Compiled Wire vs. code generated by tools/protogen.py")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+    import protogen
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "mesh.proto"), "w") as f:
+        f.write(MESH_PROTO)
+    protogen.main([os.path.join(directory, "mesh.proto"), "-o", os.path.join(directory, "mesh_pb.py")])
+    with open(os.path.join(directory, "mesh_pb.py")) as f:
+        code = compile(f.read(), "mesh_pb.py", "exec")
+    generated = {}
+    exec(code, generated)
+
+    report("schema setup", measure(lambda _: schema_setup(), None, 500),
+           measure(lambda c: exec(c, {}), code, 500))
+    cases = (
+        ("text", MeshtasticData, TEXT, "Data"),
+        ("nodeinfo payload", MeshtasticNodeInfo, NODEINFO, "NodeInfo"),
+    )
+    for name, wire, obj, message in cases:
+        data = wire.encode(obj)
+        decode = generated["decode_" + message]
+        encode = generated["encode_" + message]
+        record = decode(data)
+        assert encode(record) == data
+        report(name + " encode", measure(wire.encode, obj), measure(encode, record))
+        report(name + " decode", measure(wire.decode, data), measure(decode, data))
+
+
+if __name__ == "__main__":
+    bench_compiled()
+    bench_fields()
+    bench_streams()
+    bench_batch()
+    bench_limits()
+    bench_codegen()
+    bench_packed()
+    bench_trusted()
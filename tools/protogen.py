@@ -0,0 +1,835 @@
+"""
+Generate precompiled minipb codecs from Meshtastic .proto files.
+
+Runs on the host. The generated module runs on the device next to
+minipb.py and needs no schema parsing or codec compilation at boot:
+every message becomes a namedtuple record, a flat field table in minipb
+notation and straight-line encode/decode functions built on minipb's
+cursor helpers.
+
+    python3 tools/protogen.py -I protobufs -m Data -m NodeInfo \\
+        --max-fields 32 --max-vint-bytes 10 --max-bytes 239 \\
+        -o armassi/lib/meshtastic_pb.py protobufs/meshtastic/mesh.proto
+
+The --max-* options bake the decode limits of Wire.set_limits() into the
+generated decoders; pass the ones comms.py uses (MESHTASTIC_LIMITS) when
+the module decodes packets off the air. Recursive messages are only
+generated with --max-depth, so a hostile packet cannot nest them until
+the stack runs out.
+
+Only the proto3 (and plain proto2) subset Meshtastic uses is understood:
+messages, nested messages and enums, oneof, repeated, packed and
+optional fields. Field options other than packed are ignored, map fields
+and groups are rejected.
+
+For each message Name the module defines:
+    Name                      namedtuple record, None for absent fields,
+                              array.array for packed numeric fields and
+                              tuples for other repeated ones
+    Name_FIELDS               ((field id, name, minipb type), ...)
+    decode_Name(data)         decode bytes/bytearray/memoryview to a record
+    encode_Name(obj)          encode a record, or a dict keyed by the
+                              .proto field names, to bytes
+    encode_Name_into(buf, offset, obj)
+                              encode into buf, return the length written
+"""
+import argparse
+import keyword
+import os
+import re
+import sys
+
+# protobuf scalar type -> (minipb type letter, wire type)
+SCALARS = {
+    "double": ("d", 1),
+    "float": ("f", 5),
+    "int32": ("t", 0),
+    "int64": ("t", 0),
+    "uint32": ("T", 0),
+    "uint64": ("T", 0),
+    "sint32": ("z", 0),
+    "sint64": ("z", 0),
+    "fixed32": ("I", 5),
+    "fixed64": ("Q", 1),
+    "sfixed32": ("i", 5),
+    "sfixed64": ("q", 1),
+    "bool": ("b", 0),
+    "string": ("U", 2),
+    "bytes": ("a", 2),
+}
+
+FIXED_SIZES = {"d": 8, "f": 4, "I": 4, "Q": 8, "i": 4, "q": 8}
+
+# array typecodes of packed vint fields, like minipb uses
+VINT_ARRAY_TYPES = {"T": "Q", "t": "q", "z": "q"}
+
+MASK64 = "0xffffffffffffffff"
+
+TOKEN = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<number>-?(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][-+]?\d+)?))
+  | (?P<ident>\.?[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+  | (?P<symbol>[{}\[\]()<>=;,:.+-])
+""", re.VERBOSE | re.DOTALL)
+
+
+class ProtoError(Exception):
+    """
+    The .proto file uses something this tool does not understand
+    """
+    pass
+
+
+class Field(object):
+    def __init__(self, name, number, type_name, label, packed, syntax):
+        self.name = name
+        self.number = number
+        self.type_name = type_name
+        # "", "repeated", "optional" or "required"
+        self.label = label
+        # None if not given, i.e. the syntax default applies
+        self.packed = packed
+        self.syntax = syntax
+        # filled in by resolve()
+        self.letter = None
+        self.wire_type = None
+        self.message = None
+        self.enum = None
+
+
+class Message(object):
+    def __init__(self, full_name, syntax):
+        self.full_name = full_name
+        self.syntax = syntax
+        self.fields = []
+
+
+class Enum(object):
+    def __init__(self, full_name):
+        self.full_name = full_name
+        self.values = []
+
+
+def tokenize(text, path):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None:
+            raise ProtoError("{0}: unexpected character {1!r}".format(path, text[pos]))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind != "space":
+            tokens.append(match.group(kind))
+    return tokens
+
+
+class Parser(object):
+    """
+    Collects the messages and enums of one or more .proto files (and the
+    files they import) by their fully qualified names.
+    """
+    def __init__(self, include_dirs):
+        self.include_dirs = include_dirs
+        self.messages = {}
+        self.enums = {}
+        # full names in the order they were defined
+        self.order = []
+        self.parsed = set()
+
+    def parse_file(self, path):
+        path = os.path.normpath(path)
+        if path in self.parsed:
+            return
+        self.parsed.add(path)
+        with open(path) as f:
+            self.tokens = tokenize(f.read(), path)
+        self.pos = 0
+        self.path = path
+        self.package = ""
+        self.syntax = "proto2"
+        imports = []
+        while not self.at_end():
+            word = self.next()
+            if word == "syntax":
+                self.expect("=")
+                self.syntax = self.next().strip("\"'")
+                self.expect(";")
+            elif word == "package":
+                self.package = self.next()
+                self.expect(";")
+            elif word == "import":
+                name = self.next()
+                if name in ("public", "weak"):
+                    name = self.next()
+                imports.append(name.strip("\"'"))
+                self.expect(";")
+            elif word == "option":
+                self.skip_statement()
+            elif word == "message":
+                self.parse_message(self.package)
+            elif word == "enum":
+                self.parse_enum(self.package)
+            elif word in ("service", "extend"):
+                self.skip_statement()
+            elif word == ";":
+                continue
+            else:
+                self.fail("unexpected {0!r}".format(word))
+
+        for name in imports:
+            found = self.find_import(name, os.path.dirname(path))
+            if found is None:
+                # e.g. nanopb.proto, which only carries field options
+                sys.stderr.write("{0}: import {1} not found, skipped\n".format(path, name))
+            else:
+                self.parse_file(found)
+
+    def find_import(self, name, here):
+        for directory in self.include_dirs + [here]:
+            candidate = os.path.join(directory, name)
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def at_end(self):
+        return self.pos >= len(self.tokens)
+
+    def next(self):
+        if self.at_end():
+            self.fail("unexpected end of file")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def peek(self):
+        return None if self.at_end() else self.tokens[self.pos]
+
+    def expect(self, token):
+        found = self.next()
+        if found != token:
+            self.fail("expected {0!r} but got {1!r}".format(token, found))
+
+    def fail(self, message):
+        raise ProtoError("{0}: {1}".format(self.path, message))
+
+    def skip_statement(self):
+        """
+        Skip to the end of a statement, or past its block if it has one.
+        """
+        depth = 0
+        while 1:
+            token = self.next()
+            if token == "{":
+                depth += 1
+            elif token == "}":
+                depth -= 1
+                if depth == 0:
+                    return
+            elif token == ";" and depth == 0:
+                return
+
+    def parse_options(self):
+        """
+        Parse a [name = value, ...] field option list. Returns the value
+        of packed if given.
+        """
+        packed = None
+        self.expect("[")
+        while 1:
+            name = []
+            while self.peek() != "=":
+                name.append(self.next())
+            self.expect("=")
+            value = self.next()
+            if value == "{":
+                self.pos -= 1
+                self.skip_statement()
+            elif value == "-":
+                value += self.next()
+            if "".join(name) == "packed":
+                packed = value == "true"
+            token = self.next()
+            if token == "]":
+                return packed
+            if token != ",":
+                self.fail("expected ',' or ']' in field options")
+
+    def parse_message(self, scope):
+        full_name = scope + "." + self.next() if scope else self.next()
+        message = Message(full_name, self.syntax)
+        self.messages[full_name] = message
+        self.order.append(full_name)
+        self.expect("{")
+        while 1:
+            word = self.next()
+            if word == "}":
+                return
+            if word == ";":
+                continue
+            if word == "message":
+                self.parse_message(full_name)
+            elif word == "enum":
+                self.parse_enum(full_name)
+            elif word in ("option", "reserved", "extensions", "extend"):
+                self.skip_statement()
+            elif word == "oneof":
+                self.next()
+                self.expect("{")
+                while self.peek() != "}":
+                    word = self.next()
+                    if word == "option":
+                        self.skip_statement()
+                    elif word != ";":
+                        message.fields.append(self.parse_field("optional", word))
+                self.expect("}")
+            elif word == "map":
+                self.fail("map fields are not supported ({0})".format(full_name))
+            elif word == "group" or self.peek() == "group":
+                self.fail("groups are not supported ({0})".format(full_name))
+            elif word in ("repeated", "optional", "required"):
+                message.fields.append(self.parse_field(word, self.next()))
+            else:
+                message.fields.append(self.parse_field("", word))
+
+    def parse_field(self, label, type_name):
+        name = self.next()
+        self.expect("=")
+        number = int(self.next(), 0)
+        packed = None
+        if self.peek() == "[":
+            packed = self.parse_options()
+        self.expect(";")
+        if not 0 < number < (1 << 29):
+            self.fail("field number {0} of {1} is out of range".format(number, name))
+        return Field(name, number, type_name, label, packed, self.syntax)
+
+    def parse_enum(self, scope):
+        full_name = scope + "." + self.next() if scope else self.next()
+        enum = Enum(full_name)
+        self.enums[full_name] = enum
+        self.order.append(full_name)
+        self.expect("{")
+        while 1:
+            word = self.next()
+            if word == "}":
+                return
+            if word == ";":
+                continue
+            if word in ("option", "reserved"):
+                self.skip_statement()
+                continue
+            self.expect("=")
+            value = self.next()
+            if value == "-":
+                value += self.next()
+            if self.peek() == "[":
+                self.parse_options()
+            self.expect(";")
+            enum.values.append((word, int(value, 0)))
+
+    def resolve(self):
+        """
+        Look up the type of every field the way protoc does, from the
+        innermost scope outwards.
+        """
+        for message in self.messages.values():
+            for field in message.fields:
+                if field.type_name in SCALARS:
+                    field.letter, field.wire_type = SCALARS[field.type_name]
+                    continue
+                found = self.lookup(field.type_name, message.full_name)
+                if found in self.enums:
+                    field.letter, field.wire_type = "t", 0
+                    field.enum = found
+                elif found in self.messages:
+                    field.message = self.messages[found]
+                    field.letter, field.wire_type = None, 2
+                else:
+                    raise ProtoError("unknown type {0} of {1}.{2}".format(
+                        field.type_name, message.full_name, field.name))
+
+    def lookup(self, name, scope):
+        if name.startswith("."):
+            return name[1:]
+        parts = scope.split(".")
+        while parts:
+            candidate = ".".join(parts + [name])
+            if candidate in self.messages or candidate in self.enums:
+                return candidate
+            parts.pop()
+        return name
+
+
+class Generator(object):
+    """
+    Writes the Python module for the selected messages and everything
+    they refer to.
+    """
+    def __init__(self, parser, roots, sources, max_depth=None, max_fields=None,
+                 max_vint_bytes=None, max_bytes=None):
+        self.parser = parser
+        self.sources = sources
+        self.max_depth = max_depth
+        self.max_fields = max_fields
+        self.max_vint_bytes = max_vint_bytes
+        self.max_bytes = max_bytes
+        self.selected = self.select(roots)
+        if max_depth is None:
+            for full_name in self.selected:
+                if full_name in parser.messages and self.is_recursive(parser.messages[full_name]):
+                    raise ProtoError("message {0} is recursive, give --max-depth to bound its "
+                                     "decoding".format(full_name))
+        self.lines = []
+
+    def select(self, roots):
+        """
+        Full names of the messages and enums to generate, in definition
+        order. All of them if no roots are given.
+        """
+        parser = self.parser
+        if not roots:
+            return list(parser.order)
+        wanted = set()
+        pending = []
+        for root in roots:
+            found = [name for name in parser.messages
+                     if name == root or name.endswith("." + root)]
+            if len(found) != 1:
+                raise ProtoError("message {0} is {1}".format(
+                    root, "ambiguous" if found else "not defined"))
+            pending.append(found[0])
+        while pending:
+            name = pending.pop()
+            if name in wanted:
+                continue
+            wanted.add(name)
+            for field in parser.messages[name].fields:
+                if field.message is not None:
+                    pending.append(field.message.full_name)
+                elif field.enum is not None:
+                    wanted.add(field.enum)
+        return [name for name in parser.order if name in wanted]
+
+    @staticmethod
+    def is_recursive(message):
+        """
+        True if message can contain itself, directly or further down.
+        """
+        seen = set()
+        pending = [message]
+        while pending:
+            for field in pending.pop().fields:
+                if field.message is message:
+                    return True
+                if field.message is not None and field.message.full_name not in seen:
+                    seen.add(field.message.full_name)
+                    pending.append(field.message)
+        return False
+
+    def py_name(self, full_name):
+        """
+        meshtastic.User -> User, meshtastic.Config.LoRaConfig -> Config_LoRaConfig
+        """
+        parser = self.parser
+        # strip the package, which is the longest prefix that is not a type
+        parts = full_name.split(".")
+        for index in range(len(parts)):
+            if ".".join(parts[:index + 1]) in parser.messages or ".".join(parts[:index + 1]) in parser.enums:
+                return "_".join(parts[index:])
+        return "_".join(parts)
+
+    @staticmethod
+    def attr_name(name):
+        return name + "_" if keyword.iskeyword(name) else name
+
+    def emit(self, line="", indent=0):
+        self.lines.append("    " * indent + line if line else "")
+
+    def generate(self):
+        self.emit("# Generated by tools/protogen.py from {0}. Do not edit.".format(", ".join(self.sources)))
+        self.emit("from array import array")
+        self.emit("from collections import namedtuple")
+        self.emit("import struct")
+        self.emit()
+        imports = ["CodecError", "_TRUNCATED", "_vint_at", "_skip_at", "_put_vint", "_put_bytes", "_close_length"]
+        if self.max_vint_bytes is not None:
+            imports.append("_vint_reader")
+        if self.max_depth is not None:
+            imports.append("_too_deep")
+        if self.max_fields is not None:
+            imports.append("_too_many_fields")
+        self.emit("from minipb import {0}".format(", ".join(imports)))
+        self.emit()
+        self.emit("unpack_from = struct.unpack_from")
+        self.emit("pack_into = struct.pack_into")
+        self.emit()
+        limits = [(name, value) for name, value in (
+            ("MAX_DEPTH", self.max_depth), ("MAX_FIELDS", self.max_fields),
+            ("MAX_VINT_BYTES", self.max_vint_bytes), ("MAX_BYTES", self.max_bytes)) if value is not None]
+        if limits:
+            self.emit("# Decode limits, as Wire.set_limits() takes them")
+            for name, value in limits:
+                self.emit("{0} = {1}".format(name, value))
+            if self.max_vint_bytes is not None:
+                self.emit("_vint_at = _vint_reader(MAX_VINT_BYTES)")
+            self.emit()
+        self.emit("# encode_*() work in here and copy the result out")
+        self.emit("_scratch = [bytearray(64)]")
+        self.emit()
+        self.emit()
+        self.emit("def _decode(dec, data):")
+        if self.max_bytes is not None:
+            self.emit("if len(data) > MAX_BYTES:", 1)
+            self.emit("raise CodecError('Message size {0} is over the limit of {1} bytes'.format("
+                      "len(data), MAX_BYTES))", 2)
+        self.emit("try:", 1)
+        self.emit("return dec(memoryview(data), 0, len(data){0})".format(
+            "" if self.max_depth is None else ", 1"), 2)
+        self.emit("except _TRUNCATED:", 1)
+        self.emit("raise CodecError('Unexpected end of message')", 2)
+        self.emit("except OverflowError:", 1)
+        self.emit("raise CodecError('Packed value does not fit its array type')", 2)
+        self.emit()
+        self.emit()
+        self.emit("def _encode(enc, obj):")
+        self.emit("buf = _scratch[0]", 1)
+        self.emit("while 1:", 1)
+        self.emit("try:", 2)
+        self.emit("return bytes(memoryview(buf)[:enc(obj, buf, 0)])", 3)
+        self.emit("except IndexError:", 2)
+        self.emit("buf = _scratch[0] = bytearray(len(buf) * 2)", 3)
+        self.emit()
+        self.emit()
+        self.emit("def _encode_into(enc, buf, offset, obj):")
+        self.emit("try:", 1)
+        self.emit("return enc(obj, buf, offset) - offset", 2)
+        self.emit("except IndexError:", 1)
+        self.emit("raise CodecError('Buffer too small to hold the message')", 2)
+        self.emit()
+        self.emit()
+        self.emit("def _from_dict(record, obj, keys):")
+        self.emit("try:", 1)
+        self.emit("return record(*[obj[key] for key in keys])", 2)
+        self.emit("except KeyError as e:", 1)
+        self.emit("raise CodecError('Insufficient parameters '", 2)
+        self.emit(" '(empty field {0} not padded with None)'.format(e.args[0]))", 6)
+
+        for full_name in self.selected:
+            if full_name in self.parser.enums:
+                self.generate_enum(self.parser.enums[full_name])
+            else:
+                self.generate_message(self.parser.messages[full_name])
+        self.emit()
+        return "\n".join(self.lines)
+
+    def generate_enum(self, enum):
+        name = self.py_name(enum.full_name)
+        self.emit()
+        self.emit()
+        self.emit("# enum {0}".format(enum.full_name))
+        for value_name, value in enum.values:
+            self.emit("{0}_{1} = {2}".format(name, value_name, value))
+
+    def type_code(self, field):
+        """
+        The field in minipb format notation, with the record name for
+        nested messages.
+        """
+        if field.message is not None:
+            code = self.py_name(field.message.full_name)
+        else:
+            code = field.letter
+        if field.label == "repeated":
+            return ("#" if self.is_packed(field) else "+") + code
+        if field.label == "required":
+            return "*" + code
+        return code
+
+    @staticmethod
+    def is_packed(field):
+        if field.label != "repeated" or field.wire_type == 2:
+            return False
+        if field.packed is not None:
+            return field.packed
+        return field.syntax == "proto3"
+
+    @classmethod
+    def array_typecode(cls, field):
+        """
+        Typecode of the array.array a packed field is decoded into, or
+        None if it is decoded into a tuple.
+        """
+        if not cls.is_packed(field):
+            return None
+        if field.letter in FIXED_SIZES:
+            return field.letter
+        return VINT_ARRAY_TYPES.get(field.letter)
+
+    def generate_message(self, message):
+        name = self.py_name(message.full_name)
+        fields = sorted(message.fields, key=lambda field: field.number)
+        names = [self.attr_name(field.name) for field in message.fields]
+
+        self.emit()
+        self.emit()
+        self.emit("# message {0}".format(message.full_name))
+        self.emit("{0} = namedtuple({0!r}, {1!r})".format(name, tuple(names)))
+        self.emit("{0}_FIELDS = (".format(name))
+        for field in fields:
+            self.emit("({0}, {1!r}, {2!r}),".format(field.number, field.name, self.type_code(field)), 1)
+        self.emit(")")
+
+        # decoder
+        self.emit()
+        self.emit()
+        if self.max_depth is None:
+            self.emit("def _dec_{0}(buf, pos, end):".format(name))
+        else:
+            self.emit("def _dec_{0}(buf, pos, end, depth):".format(name))
+            self.emit("if depth > MAX_DEPTH:", 1)
+            self.emit("raise _too_deep(MAX_DEPTH)", 2)
+        if fields:
+            self.emit(" = ".join("f_" + field.name for field in message.fields) + " = None", 1)
+        if self.max_fields is not None:
+            self.emit("count = 0", 1)
+        self.emit("while pos < end:", 1)
+        self.emit("tag, pos = _vint_at(buf, pos)", 2)
+        if self.max_fields is not None:
+            self.emit("count += 1", 2)
+            self.emit("if count > MAX_FIELDS:", 2)
+            self.emit("raise _too_many_fields(MAX_FIELDS)", 3)
+        keyword_ = "if"
+        for field in fields:
+            tags = [(field.number << 3) | field.wire_type]
+            if field.label == "repeated" and field.wire_type != 2:
+                # parsers must take both packed and unpacked encodings
+                tags.append((field.number << 3) | 2)
+            for tag in tags:
+                self.emit("{0} tag == {1}:".format(keyword_, tag), 2)
+                keyword_ = "elif"
+                self.decode_field(field, tag & 7 != field.wire_type)
+        if self.max_vint_bytes is None:
+            skip = "pos = _skip_at(buf, pos, tag & 7)"
+        else:
+            skip = "pos = _skip_at(buf, pos, tag & 7, _vint_at)"
+        if fields:
+            self.emit("else:", 2)
+            self.emit(skip, 3)
+        else:
+            self.emit(skip, 2)
+        self.emit("if pos != end:", 1)
+        self.emit("raise CodecError('Unexpected end of message')", 2)
+        for field in message.fields:
+            if field.label == "repeated" and self.array_typecode(field):
+                self.emit("if f_{0} is None:".format(field.name), 1)
+                self.emit("f_{0} = array({1!r})".format(field.name, self.array_typecode(field)), 2)
+            elif field.label == "repeated":
+                self.emit("f_{0} = () if f_{0} is None else tuple(f_{0})".format(field.name), 1)
+            elif field.label == "required":
+                self.emit("if f_{0} is None:".format(field.name), 1)
+                self.emit("raise CodecError('Field {0} is required but is empty')".format(field.name), 2)
+        self.emit("return {0}({1})".format(name, ", ".join("f_" + field.name for field in message.fields)), 1)
+
+        # encoder
+        self.emit()
+        self.emit()
+        self.emit("def _enc_{0}(obj, buf, pos):".format(name))
+        self.emit("if isinstance(obj, dict):", 1)
+        self.emit("obj = _from_dict({0}, obj, {1!r})".format(
+            name, tuple(field.name for field in message.fields)), 2)
+        for index, field in enumerate(message.fields):
+            self.emit("value = obj[{0}]".format(index), 1)
+            if field.label == "repeated":
+                self.emit("if value:", 1)
+                if self.array_typecode(field) and field.letter in FIXED_SIZES:
+                    size = FIXED_SIZES[field.letter]
+                    self.emit_header(field.number, 2, 2)
+                    self.emit("pos = _put_vint(buf, pos, len(value) * {0})".format(size), 2)
+                    self.emit("if pos + len(value) * {0} > len(buf):".format(size), 2)
+                    self.emit("raise IndexError('buffer too small')", 3)
+                    self.emit("pack_into('<%d{0}' % len(value), buf, pos, *value)".format(field.letter), 2)
+                    self.emit("pos += len(value) * {0}".format(size), 2)
+                elif self.is_packed(field):
+                    self.emit_header(field.number, 2, 2)
+                    self.emit("start = pos", 2)
+                    self.emit("pos += 1", 2)
+                    self.emit("for item in value:", 2)
+                    self.encode_value(field, "item", 3)
+                    self.emit("pos = _close_length(buf, start, pos)", 2)
+                else:
+                    self.emit("for item in value:", 2)
+                    self.emit_header(field.number, field.wire_type, 3)
+                    self.encode_value(field, "item", 3)
+                continue
+            if field.label == "required":
+                self.emit("if value is None:", 1)
+                self.emit("raise CodecError('Required field cannot be None.')", 2)
+                self.emit_header(field.number, field.wire_type, 1)
+                self.encode_value(field, "value", 1)
+                continue
+            self.emit("if value is not None:", 1)
+            self.emit_header(field.number, field.wire_type, 2)
+            self.encode_value(field, "value", 2)
+        self.emit("return pos", 1)
+
+        # public API
+        self.emit()
+        self.emit()
+        self.emit("def decode_{0}(data):".format(name))
+        self.emit("return _decode(_dec_{0}, data)".format(name), 1)
+        self.emit()
+        self.emit()
+        self.emit("def encode_{0}(obj):".format(name))
+        self.emit("return _encode(_enc_{0}, obj)".format(name), 1)
+        self.emit()
+        self.emit()
+        self.emit("def encode_{0}_into(buf, offset, obj):".format(name))
+        self.emit("return _encode_into(_enc_{0}, buf, offset, obj)".format(name), 1)
+
+    def decode_field(self, field, packed, indent=3):
+        """
+        Read one occurrence of field at pos into its f_<name> variable.
+        """
+        var = "f_" + field.name
+        if field.label != "repeated":
+            self.read_value(field, var, indent)
+            return
+        typecode = self.array_typecode(field)
+        if packed and typecode and field.letter in FIXED_SIZES:
+            # the whole run in a single struct call
+            size = FIXED_SIZES[field.letter]
+            self.emit("length, pos = _vint_at(buf, pos)", indent)
+            self.emit("if length % {0}:".format(size), indent)
+            self.emit("raise CodecError('Unexpected end of message while decoding field {0}')".format(
+                field.number), indent + 1)
+            self.emit("value = array({0!r}, unpack_from('<%d{0}' % (length // {1}), buf, pos))".format(
+                field.letter, size), indent)
+            self.emit("if {0} is None:".format(var), indent)
+            self.emit("{0} = value".format(var), indent + 1)
+            self.emit("else:", indent)
+            self.emit("{0}.extend(value)".format(var), indent + 1)
+            self.emit("pos += length", indent)
+            return
+        self.emit("if {0} is None:".format(var), indent)
+        if typecode:
+            self.emit("{0} = array({1!r})".format(var, typecode), indent + 1)
+        else:
+            self.emit("{0} = []".format(var), indent + 1)
+        if packed:
+            self.emit("length, pos = _vint_at(buf, pos)", indent)
+            self.emit("stop = pos + length", indent)
+            self.emit("while pos < stop:", indent)
+            self.read_value(field, "value", indent + 1)
+            self.emit("{0}.append(value)".format(var), indent + 1)
+            self.emit("if pos != stop:", indent)
+            self.emit("raise CodecError('Unexpected end of message while decoding field {0}')".format(
+                field.number), indent + 1)
+        else:
+            self.read_value(field, "value", indent)
+            self.emit("{0}.append(value)".format(var), indent)
+
+    def read_value(self, field, var, indent):
+        letter = field.letter
+        if field.message is not None:
+            self.emit("length, pos = _vint_at(buf, pos)", indent)
+            self.emit("{0} = _dec_{1}(buf, pos, pos + length{2})".format(
+                var, self.py_name(field.message.full_name),
+                "" if self.max_depth is None else ", depth + 1"), indent)
+            self.emit("pos += length", indent)
+        elif letter in ("a", "U"):
+            self.emit("length, pos = _vint_at(buf, pos)", indent)
+            if letter == "a":
+                self.emit("{0} = bytes(buf[pos:pos + length])".format(var), indent)
+            else:
+                self.emit("{0} = str(buf[pos:pos + length], 'utf-8')".format(var), indent)
+            self.emit("pos += length", indent)
+        elif letter in FIXED_SIZES:
+            self.emit("{0} = unpack_from('<{1}', buf, pos)[0]".format(var, letter), indent)
+            self.emit("pos += {0}".format(FIXED_SIZES[letter]), indent)
+        else:
+            self.emit("{0}, pos = _vint_at(buf, pos)".format(var), indent)
+            if letter == "t":
+                self.emit("if ({0} >> 63) & 1:".format(var), indent)
+                self.emit("{0} = ~(~{0} & {1})".format(var, MASK64), indent + 1)
+            elif letter == "z":
+                self.emit("{0} = ~({0} >> 1) if {0} & 1 else {0} >> 1".format(var), indent)
+            elif letter == "b":
+                self.emit("{0} = {0} != 0".format(var), indent)
+
+    def emit_header(self, number, wire_type, indent):
+        header = (number << 3) | wire_type
+        if header < 0x80:
+            self.emit("buf[pos] = {0}".format(header), indent)
+            self.emit("pos += 1", indent)
+            return
+        encoded = bytearray()
+        while header > 0x7f:
+            encoded.append((header & 0x7f) | 0x80)
+            header >>= 7
+        encoded.append(header)
+        self.emit("pos = _put_bytes(buf, pos, {0!r})".format(bytes(encoded)), indent)
+
+    def encode_value(self, field, var, indent):
+        letter = field.letter
+        if field.message is not None:
+            self.emit("pos = _close_length(buf, pos, _enc_{0}({1}, buf, pos + 1))".format(
+                self.py_name(field.message.full_name), var), indent)
+        elif letter in ("a", "U"):
+            if letter == "U":
+                self.emit("{0} = {0}.encode('utf-8')".format(var), indent)
+            self.emit("pos = _put_bytes(buf, _put_vint(buf, pos, len({0})), {0})".format(var), indent)
+        elif letter in FIXED_SIZES:
+            size = FIXED_SIZES[letter]
+            self.emit("if pos + {0} > len(buf):".format(size), indent)
+            self.emit("raise IndexError('buffer too small')", indent + 1)
+            self.emit("pack_into('<{0}', buf, pos, {1})".format(letter, var), indent)
+            self.emit("pos += {0}".format(size), indent)
+        elif letter == "t":
+            self.emit("pos = _put_vint(buf, pos, {0} & {1})".format(var, MASK64), indent)
+        elif letter == "z":
+            self.emit("pos = _put_vint(buf, pos, ~({0} << 1) if {0} < 0 else {0} << 1)".format(var), indent)
+        elif letter == "b":
+            self.emit("pos = _put_vint(buf, pos, int({0}))".format(var), indent)
+        else:
+            self.emit("pos = _put_vint(buf, pos, {0})".format(var), indent)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("protos", nargs="+", help=".proto files to generate code for")
+    parser.add_argument("-I", "--proto-path", action="append", default=[],
+                        help="directory to look for imported files in (repeatable)")
+    parser.add_argument("-m", "--message", action="append", default=[],
+                        help="only generate this message and what it refers to (repeatable)")
+    parser.add_argument("-o", "--output", help="output file, stdout if not given")
+    parser.add_argument("--max-depth", type=int,
+                        help="decode nested messages this deep at most, the top level being 1")
+    parser.add_argument("--max-fields", type=int, help="fields any single message may have")
+    parser.add_argument("--max-vint-bytes", type=int, help="bytes any vint may take")
+    parser.add_argument("--max-bytes", type=int, help="size of a whole message")
+    args = parser.parse_args(argv)
+
+    protos = Parser(args.proto_path)
+    try:
+        for path in args.protos:
+            protos.parse_file(path)
+        protos.resolve()
+        code = Generator(protos, args.message, [os.path.basename(path) for path in args.protos],
+                         max_depth=args.max_depth, max_fields=args.max_fields,
+                         max_vint_bytes=args.max_vint_bytes, max_bytes=args.max_bytes).generate()
+    except ProtoError as e:
+        sys.stderr.write("protogen: {0}\n".format(e))
+        return 1
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(code)
+    else:
+        sys.stdout.write(code)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())